@@ -0,0 +1,125 @@
+# Compare the --intern policies for the strings of parsed json: load time and
+# memory of loading the same data sources under each, every policy in a fresh
+# process.
+#
+#   python bench_intern.py [--policies none,keys,whitelist,all]
+#                          [--tweets 100000] [--seed 0] [datasources...]
+#
+# Without data sources a synthetic HAR of home timeline pages is written to a
+# temporary directory: --tweets tweets by a few thousand users, with unique
+# texts and links, a handful of languages and clients, and media on some.
+
+import argparse, contextlib, io, json, os, random, resource, subprocess, sys, tempfile, time
+
+def rss_kb():
+	with open("/proc/self/status") as f:
+		for line in f:
+			if line.startswith("VmRSS:"):
+				return int(line.split()[1])
+
+def child(policy, sources):
+	sys.argv[1:] = ["--no-load", "--intern=" + policy]
+	rss0 = rss_kb()
+	import db as dbmodule
+	db = dbmodule.db
+	t0 = time.perf_counter()
+	with contextlib.redirect_stdout(io.StringIO()):
+		for path in dbmodule.gather_paths(sources):
+			dbmodule.load_single(path)
+		db.sort_profiles()
+	seconds = time.perf_counter() - t0
+	print(json.dumps({
+		"policy": policy,
+		"seconds": seconds,
+		"json_seconds": sum(source.get("json_seconds", 0) for source in db.ingest.sources.values()),
+		"rss_kb": rss_kb() - rss0,
+		"peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		"tweets": len(db.tweets),
+		"profiles": len(db.profiles)
+	}))
+
+words = ("the a of to and in is it you that was for on are with as be this have from or one had by "
+	"but not what all were we when your can said there use an each which she do how their if will up "
+	"other about out many then them these so some her would make like him into time has look two more").split()
+
+def synthetic_har(path, n, rng):
+	langs = ["en"] * 12 + ["ja", "de", "fr", "es", "und", "qme", "zxx"]
+	sources = ['<a href="https://{0}" rel="nofollow">{1}</a>'.format(*s) for s in (
+		("mobile.twitter.com", "Twitter Web App"), ("twitter.com/download/iphone", "Twitter for iPhone"),
+		("twitter.com/download/android", "Twitter for Android"), ("tweetdeck.twitter.com", "TweetDeck"),
+		("help.twitter.com/using-twitter/how-to-tweet#source-labels", "Twitter for iPad"))]
+	sizes = {"w": 1200, "h": 675, "resize": "fit"}
+	users = []
+	for uid in range(1, max(2, n // 30)):
+		users.append({"__typename": "User", "rest_id": str(uid), "legacy": {
+			"screen_name": "user{}".format(uid), "name": " ".join(rng.choice(words).title() for i in range(2)),
+			"created_at": "Wed Oct 10 20:19:24 +0000 2018", "description": " ".join(rng.choice(words) for i in range(12)),
+			"profile_image_url_https": "https://pbs.twimg.com/profile_images/{}/x_normal.jpg".format(rng.getrandbits(60)),
+			"translator_type": "none", "followers_count": rng.randrange(10000)}})
+	entries = []
+	page = []
+	for i in range(n):
+		twid = (1500000000000 + i * 1000) << 22
+		user = rng.choice(users)
+		legacy = {
+			"id_str": str(twid), "user_id_str": user["rest_id"], "created_at": "Wed Oct 10 20:19:24 +0000 2018",
+			"full_text": " ".join(rng.choice(words) for j in range(rng.randrange(5, 40))),
+			"lang": rng.choice(langs), "source": rng.choice(sources), "favorite_count": rng.randrange(100),
+			"entities": {"hashtags": [], "symbols": [], "user_mentions": [], "urls": []}}
+		if rng.random() < 0.3:
+			short = "https://t.co/{:010x}".format(rng.getrandbits(40))
+			legacy["entities"]["urls"].append({"url": short, "expanded_url": "https://example.com/{:x}".format(rng.getrandbits(64)),
+				"display_url": "example.com/…", "indices": [0, 23]})
+		if rng.random() < 0.2:
+			media = {"id_str": str(twid + 1), "media_key": "3_{}".format(twid + 1), "type": "photo",
+				"media_url_https": "https://pbs.twimg.com/media/{:x}.jpg".format(rng.getrandbits(64)),
+				"url": "https://t.co/{:010x}".format(rng.getrandbits(40)),
+				"sizes": {name: dict(sizes) for name in ("large", "medium", "small", "thumb")}}
+			legacy["entities"]["media"] = [media]
+			legacy["extended_entities"] = {"media": [dict(media)]}
+		tweet = {"__typename": "Tweet", "rest_id": str(twid), "core": {"user_results": {"result": user}}, "legacy": legacy}
+		page.append({"entryId": "tweet-" + str(twid), "sortIndex": str(twid), "content": {
+			"entryType": "TimelineTimelineItem", "__typename": "TimelineTimelineItem", "itemContent": {
+				"itemType": "TimelineTweet", "__typename": "TimelineTweet", "tweetDisplayType": "Tweet",
+				"tweet_results": {"result": tweet}}}})
+		if len(page) == 40 or i == n - 1:
+			data = {"data": {"home": {"home_timeline_urt": {"instructions": [{"type": "TimelineAddEntries", "entries": page}]}}}}
+			entries.append({"startedDateTime": "2024-01-01T00:00:00.000Z",
+				"request": {"url": "https://x.com/i/api/graphql/bench/HomeTimeline?variables=%7B%7D", "cookies": [{"name": "twid", "value": "u%3D1"}]},
+				"response": {"content": {"mimeType": "application/json", "size": 0, "text": json.dumps(data)}}})
+			page = []
+	with open(path, "w") as f:
+		json.dump({"log": {"entries": entries}}, f)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--policies", default="none,keys,whitelist,all")
+	parser.add_argument("--tweets", type=int, default=100000)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--child", help=argparse.SUPPRESS)
+	parser.add_argument("sources", nargs="*")
+	args = parser.parse_args()
+
+	if args.child:
+		child(args.child, args.sources)
+		return
+
+	here = os.path.dirname(os.path.abspath(__file__))
+	with tempfile.TemporaryDirectory() as tmp:
+		sources = [os.path.abspath(source) for source in args.sources]
+		if not sources:
+			sources = [os.path.join(tmp, "bench.har")]
+			synthetic_har(sources[0], args.tweets, random.Random(args.seed))
+			print("synthetic corpus: {} tweets, {} MB".format(args.tweets, os.path.getsize(sources[0]) // 1024**2))
+		print("{:10s} {:>8s} {:>8s} {:>10s} {:>10s} {:>8s} {:>8s}".format(
+			"policy", "load s", "json s", "rss MB", "peak MB", "tweets", "profiles"))
+		for policy in args.policies.split(","):
+			# run from a directory without ignore.txt or harstore of the checkout
+			out = subprocess.run([sys.executable, os.path.join(here, "bench_intern.py"), "--child", policy] + sources,
+				cwd=tmp, capture_output=True, text=True, check=True).stdout
+			r = json.loads(out.strip().rsplit("\n", 1)[-1])
+			print("{:10s} {:8.2f} {:8.2f} {:10.1f} {:10.1f} {:8d} {:8d}".format(
+				policy, r["seconds"], r["json_seconds"], r["rss_kb"] / 1024, r["peak_kb"] / 1024, r["tweets"], r["profiles"]))
+
+if __name__ == "__main__":
+	main()
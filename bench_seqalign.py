@@ -0,0 +1,227 @@
+# Benchmark and fuzz seqalign.align and seqalign.unscramble on synthetic like
+# histories. Each history has likes, unlikes and re-likes, observed through
+# archive exports (Items of the whole list) and paged API sessions (a mix of
+# Events and Items pages from the top of the list).
+#
+#   python bench_seqalign.py [--sizes 1000,10000,100000,1000000]
+#                            [--oracle-limit 10000] [--seed 0] [--no-memory]
+#                            [-o bench_output.txt]
+#
+# Results are checked against brute-force oracles: align_reference for sizes
+# up to --oracle-limit, and for every size the properties any alignment must
+# have. How much of the order of the last export survives is reported too,
+# it can't be fully kept when Items are matched to older Events. unscramble is
+# checked against a version that sorts the blocks by their path from the root
+# of the tree.
+
+import argparse, random, sys, time, tracemalloc
+import seqalign
+
+def like_history(rng, n, page=20, sessions_per_like=1/200):
+	"n like events, returns snapshots (most recent first) and the final list"
+	order = [] # (evid, itid) in the order the likes happened
+	current = {} # itid -> evid, for live likes
+	live = [] # itids of live likes, for random picks
+	where = {} # itid -> index in live
+	snapshots = []
+	evid = 0
+	t = 0
+
+	def like(itid):
+		nonlocal evid
+		evid += rng.randrange(1, 4)
+		order.append((evid, itid))
+		if itid not in current:
+			where[itid] = len(live)
+			live.append(itid)
+		current[itid] = evid
+
+	def unlike(itid):
+		del current[itid]
+		i = where.pop(itid)
+		last = live.pop()
+		if last != itid:
+			live[i] = last
+			where[last] = i
+
+	def top():
+		for evid, itid in reversed(order):
+			if current.get(itid, None) == evid:
+				yield evid, itid
+
+	def capture(snapshot):
+		nonlocal t
+		t += 1
+		snapshot.time = t
+		snapshots.append(snapshot)
+
+	def session():
+		it = top()
+		for i in range(rng.choice([1, 1, 2, 3, 5, 10])):
+			entries = [e for e, _ in zip(it, range(page))]
+			if not entries:
+				break
+			if rng.random() < 0.7:
+				capture(seqalign.Events(entries))
+			else:
+				capture(seqalign.Items([itid for _, itid in entries]))
+
+	def export():
+		capture(seqalign.Items([itid for _, itid in top()]))
+
+	next_itid = 0
+	for i in range(n):
+		r = rng.random()
+		if r < 0.8 or not live:
+			like(next_itid)
+			next_itid += 1
+		elif r < 0.9:
+			like(rng.randrange(next_itid)) # re-like, or like again after unliking
+		else:
+			unlike(rng.choice(live))
+		if rng.random() < sessions_per_like:
+			session()
+		if i == n // 2:
+			export()
+	export()
+
+	snapshots.reverse()
+	return snapshots, list(top())
+
+def check_align(result, snapshots, final):
+	"properties any alignment of the snapshots must have"
+	evids = [evid for evid, itid in result]
+	assert evids == sorted(evids, reverse=True), "not in reverse chronological order"
+	itids = [itid for evid, itid in result]
+	assert len(set(itids)) == len(itids), "duplicate items"
+	seen = set()
+	for snap in snapshots:
+		if isinstance(snap, seqalign.Events):
+			seen.update(itid for evid, itid in snap.seq)
+		else:
+			seen.update(snap.items)
+	assert set(itids) == seen, "items lost or made up"
+
+def kept_order(result, final):
+	"fraction of neighbours in the last export that end up in the same order"
+	position = {itid: i for i, (evid, itid) in enumerate(result)}
+	pairs = list(zip(final, final[1:]))
+	if not pairs:
+		return 1.0
+	kept = sum(1 for (_, a), (_, b) in pairs if position[a] < position[b])
+	return kept / len(pairs)
+
+def block_paths(nblocks):
+	"path from the root to every block, blocks numbered breadth-first"
+	paths = [()]
+	for b in range(1, nblocks):
+		if b <= 9:
+			parent, k = 0, b-1
+		else:
+			parent, k = (b-10) // 10 + 1, (b-10) % 10
+		paths.append(paths[parent] + (k,))
+	return paths
+
+def depth_first_blocks(n):
+	nblocks = (n + 24) // 25
+	paths = block_paths(nblocks)
+	return sorted(range(nblocks), key=paths.__getitem__)
+
+def scramble(likes):
+	out = []
+	for b in depth_first_blocks(len(likes)):
+		out.extend(likes[b*25:b*25+25])
+	return out
+
+def unscramble_oracle(likes):
+	out = [None] * len(likes)
+	i = 0
+	for b in depth_first_blocks(len(likes)):
+		for j in range(b*25, min(b*25+25, len(likes))):
+			out[j] = likes[i]
+			i += 1
+	return out
+
+def measure(fn, memory):
+	"returns (result, seconds, peak bytes or None)"
+	t0 = time.perf_counter()
+	result = fn()
+	seconds = time.perf_counter() - t0
+	peak = None
+	if memory:
+		del result
+		tracemalloc.start()
+		try:
+			result = fn()
+			peak = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+	return result, seconds, peak
+
+def fmt_peak(peak):
+	return "-" if peak is None else "{:.1f}MB".format(peak / 2**20)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description="benchmark seqalign.align and seqalign.unscramble")
+	parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+	parser.add_argument("--oracle-limit", type=int, default=10000, help="largest size to compare against align_reference")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+	parser.add_argument("-o", "--output", help="also append the results to this file")
+	args = parser.parse_args(argv)
+
+	out = [sys.stdout]
+	def report(*fields):
+		line = " ".join(str(field) for field in fields)
+		for f in out:
+			print(line, file=f, flush=True)
+
+	if not args.output:
+		return bench(args, report)
+	with open(args.output, "a") as f:
+		out.append(f)
+		return bench(args, report)
+
+def bench(args, report):
+	"runs the sizes of args, returns the exit status"
+	memory = not args.no_memory
+	failed = False
+	report("{:>8} {:>10} {:>6} {:>9} {:>9} {:>9} {:>9}  {}".format(
+		"size", "function", "snaps", "seconds", "peak", "oracle", "checks", "notes"))
+	for n in [int(size) for size in args.sizes.split(",")]:
+		rng = random.Random("{}:{}".format(args.seed, n))
+
+		# align
+		snapshots, final = like_history(rng, n)
+		result, seconds, peak = measure(lambda: seqalign.align(snapshots), memory)
+		notes = ""
+		try:
+			check_align(result, snapshots, final)
+			checks = "ok"
+		except AssertionError as e:
+			checks, notes, failed = "FAIL", str(e), True
+		oracle = "skipped"
+		if n <= args.oracle_limit:
+			oracle = "ok" if result == seqalign.align_reference(snapshots) else "FAIL"
+			failed = failed or oracle == "FAIL"
+		if not notes:
+			notes = "{:.2%} of the last export in order".format(kept_order(result, final))
+		report("{:>8} {:>10} {:>6} {:>9.3f} {:>9} {:>9} {:>9}  {}".format(
+			n, "align", len(snapshots), seconds, fmt_peak(peak), oracle, checks, notes))
+		del snapshots, final, result
+
+		# unscramble
+		likes = [rng.getrandbits(63) for i in range(n)]
+		scrambled = scramble(likes)
+		result, seconds, peak = measure(lambda: seqalign.unscramble(scrambled), memory)
+		checks = "ok" if result == likes else "FAIL"
+		oracle = "ok" if result == unscramble_oracle(scrambled) else "FAIL"
+		failed = failed or "FAIL" in (checks, oracle)
+		report("{:>8} {:>10} {:>6} {:>9.3f} {:>9} {:>9} {:>9}".format(
+			n, "unscramble", "-", seconds, fmt_peak(peak), oracle, checks))
+		del likes, scrambled, result
+
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -1,9 +1,14 @@
-import sys, json, os, base64, os.path, re, zipfile, mimetypes, http.cookies
+import sys, json, os, base64, os.path, re, zipfile, mimetypes, http.cookies, hashlib, time
 import datetime, importlib.util
-import contextlib, tempfile, subprocess # for video reencoding
+import contextlib, tempfile, subprocess, shutil # for video reencoding
+import concurrent.futures, threading, bisect, heapq, collections, functools
+try: import fcntl
+except ImportError: fcntl = None
 import seqalign
+from records import RecordTable, Tweet, Profile, Freezer, tweet_is_cold, tweet_cold_summary, tweet_media_urls
+from storage import SqliteStore
 from urllib.parse import urlparse, urlunparse, parse_qs, unquote
-from har import HarStore, OnDisk, InZip, InMemory, InWarc, read_warc
+from har import HarStore, OnDisk, InZip, InMemory, InWarc, InConcat, read_warc
 
 try:
 	datetime.datetime.fromisoformat("2020-12-31T23:59:59.999Z")
@@ -44,6 +49,16 @@ class TwitterCookie(http.cookies.SimpleCookie):
 	def load(self, rawdata):
 		return self._BaseCookie__parse_string(rawdata, self.CookiePattern)
 
+# which strings of parsed json are passed through sys.intern, see --intern and
+# bench_intern.py. keys repeat in every object. of the values, only those of
+# keys with few distinct values are worth it, interning unique ones like
+# full_text or urls costs time at load and fills the intern table for nothing.
+intern_value_keys = frozenset({
+	"__typename", "type", "itemType", "entryType", "tweetDisplayType", "cursorType", "displayTreatment",
+	"lang", "source", "resize", "media_type", "content_type", "limited_actions", "reply_settings",
+	"screen_name", "name", "in_reply_to_screen_name", "translator_type", "profile_image_shape",
+})
+
 def json_object_pairs_hook(p):
 	return {
 		sys.intern(k) if type(k) is str else k:
@@ -51,14 +66,35 @@ def json_object_pairs_hook(p):
 		for k, v in p
 	}
 
-json_load_args = {"object_pairs_hook": json_object_pairs_hook}
+def json_object_pairs_hook_keys(p):
+	return {sys.intern(k): v for k, v in p}
+
+def json_object_pairs_hook_whitelist(p):
+	return {
+		sys.intern(k):
+		sys.intern(v) if type(v) is str and k in intern_value_keys else v
+		for k, v in p
+	}
+
+intern_policies = { # name -> json_load_args
+	"none": {},
+	"keys": {"object_pairs_hook": json_object_pairs_hook_keys},
+	"whitelist": {"object_pairs_hook": json_object_pairs_hook_whitelist},
+	"all": {"object_pairs_hook": json_object_pairs_hook}
+}
+
+json_load_args = dict(intern_policies["whitelist"])
 
 dicts = {}
 
 def intern_dict(d):
+	"one shared copy of equal small dicts like media sizes"
 	if not d:
 		return d
-	f = frozenset(d)
+	try:
+		f = frozenset(d.items())
+	except TypeError: # unhashable values
+		return d
 	return dicts.setdefault(f, d)
 
 class Sizes:
@@ -359,7 +395,7 @@ class VideoSet:
 	def get_variant(self, *ignore):
 		return self.entries[0], False
 
-def merge_m3u8(m3u, get):
+def merge_m3u8(m3u, get, out_path):
 	with contextlib.ExitStack() as stack:
 		rewritten = []
 		def urlmap(url):
@@ -386,15 +422,157 @@ def merge_m3u8(m3u, get):
 		with tempfile.NamedTemporaryFile(mode="w", suffix=".m3u8") as rewritten_m3u:
 			rewritten_m3u.write(rewritten)
 			rewritten_m3u.flush()
-			#rewritten_m3u.close()
-			with tempfile.NamedTemporaryFile(mode="rb", suffix=".mp4") as merged_mp4:
-				subprocess.check_call(["ffmpeg", "-y", "-allowed_extensions", "ALL", "-i", rewritten_m3u.name, "-c", "copy", "-strict", "-2", merged_mp4.name])
-				return merged_mp4.read()
+			subprocess.check_call(["ffmpeg", "-y", "-allowed_extensions", "ALL", "-i", rewritten_m3u.name, "-c", "copy", "-strict", "-2", out_path])
+
+def concat_m3u8(m3u, get):
+	# fragmented mp4 (an init segment plus .m4s fragments) is playable as the
+	# plain concatenation of its segments, no need to involve ffmpeg
+	if not re.search(r'^#EXT-X-MAP:URI="(.*)"', m3u, re.M):
+		return None
+	urls = m3u8_segment_urls(m3u)
+	if not all(urlparse(url).path.endswith((".mp4", ".m4s")) for url in urls):
+		return None
+	item = InConcat([get(url) for url in urls])
+	item.mime = "video/mp4"
+	return item
+
+def m3u8_segment_urls(m3u):
+	urls = []
+	for line in m3u.splitlines():
+		if m := re.match(r'#EXT-X-MAP:URI="(.*)"', line):
+			urls.append(m.group(1))
+		elif line and not line.startswith("#"):
+			urls.append(line)
+	return urls
+
+class RemuxCache:
+	# merged videos on disk, named by a hash of the variant playlist and the
+	# identities of the segments it was built from. least recently served
+	# files are deleted once the directory grows beyond the budget.
+
+	def __init__(self, path, budget=4 * 1024**3):
+		self.path = path # created with the first video
+		self.budget = budget
+		self.hits = self.misses = 0
+
+	def key(self, m3u, get):
+		h = hashlib.sha1(m3u.encode("utf-8"))
+		for url in m3u8_segment_urls(m3u):
+			h.update(b"\0" + get(url).identity().encode("utf-8"))
+		return h.hexdigest()
+
+	def get(self, key):
+		path = os.path.join(self.path, key + ".mp4")
+		try:
+			st = os.stat(path)
+		except FileNotFoundError:
+			self.misses += 1
+			return None
+		self.hits += 1
+		# atime records use for eviction, mtime stays put for If-Range/If-Modified-Since
+		os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+		item = OnDisk(path)
+		item.mime = "video/mp4"
+		return item
+
+	def put(self, key, write):
+		path = os.path.join(self.path, key + ".mp4")
+		os.makedirs(self.path, exist_ok=True)
+		fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix="tmp-", suffix=".mp4")
+		os.close(fd)
+		try:
+			write(tmp_path)
+			os.replace(tmp_path, path)
+		finally:
+			if os.path.exists(tmp_path):
+				os.unlink(tmp_path)
+		self.evict(keep=path)
+		return self.get(key)
+
+	@contextlib.contextmanager
+	def locked(self, key):
+		# keeps forked workers from remuxing the same video at the same time
+		if not fcntl:
+			yield
+			return
+		os.makedirs(self.path, exist_ok=True)
+		with open(os.path.join(self.path, key + ".lock"), "w") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def evict(self, keep=None):
+		entries = []
+		total = 0
+		if not os.path.isdir(self.path):
+			return
+		for name in os.listdir(self.path):
+			if name.startswith("tmp-") or not name.endswith(".mp4"):
+				continue
+			path = os.path.join(self.path, name)
+			try:
+				st = os.stat(path)
+			except FileNotFoundError:
+				continue # evicted by another worker
+			entries.append((st.st_atime_ns, st.st_size, path))
+			total += st.st_size
+		entries.sort()
+		for atime, size, path in entries:
+			if total <= self.budget:
+				break
+			if path == keep:
+				continue
+			# the .lock stays, another worker may hold it to remux this video again
+			try:
+				os.unlink(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+
+class RemuxQueue:
+	# a bounded pool for remux jobs. requests for a video that is already
+	# being remuxed wait for that job instead of starting another ffmpeg.
+
+	def __init__(self, cache, workers=2):
+		self.cache = cache
+		self.workers = workers
+		self.reset()
+		if hasattr(os, "register_at_fork"):
+			# forked server workers start with an empty pool of their own
+			os.register_at_fork(after_in_child=self.reset)
+
+	def reset(self):
+		self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="remux")
+		self.lock = threading.Lock()
+		self.jobs = {}
+
+	def submit(self, key, write):
+		with self.lock:
+			job = self.jobs.get(key, None)
+			if job is None:
+				job = self.jobs[key] = self.executor.submit(self.run, key, write)
+		return job
+
+	def run(self, key, write):
+		try:
+			with self.cache.locked(key):
+				# another process may have finished it while we waited for the lock
+				return self.cache.get(key) or self.cache.put(key, write)
+		except Exception as e:
+			print("remux failed", key, repr(e))
+			raise
+		finally:
+			with self.lock:
+				del self.jobs[key]
 
 class MediaStore:
-	def __init__(self):
+	def __init__(self, data_dir="."):
 		self.media_by_url = {}
 		self.media_by_name = {}
+		self.remux_cache = RemuxCache(os.path.join(data_dir, "remuxcache"))
+		self.remux_queue = RemuxQueue(self.remux_cache)
 
 	# add images
 
@@ -409,7 +587,7 @@ class MediaStore:
 			path = tweets_media+"/"+media_fname
 			if isinstance(fs, ZipFS):
 				item = InZip(fs.zipf, path)
-				item.mime = mimetypes.guess_type(path)
+				item.mime = mimetypes.guess_type(path)[0]
 			else:
 				item = OnDisk(path)
 
@@ -452,44 +630,72 @@ class MediaStore:
 
 	# remux video
 
-	def lookup_video(self, url):
-
-		def get(url):
-			# awkward because this class is designed for imagesets and not videos
-			if url.startswith("/"):
-				url = "https://video.twimg.com" + url
-			cache_key, _, _ = decode_twimg(url)
-			if cache_key not in self.media_by_url:
-				return None
-			item, _ = self.media_by_url[cache_key].get_variant(None, None)
-			return item
-
-		assert url
-		top_m3u_item = get(url.replace(".m3u8.mp4", ".m3u8"))
-		top_m3u = top_m3u_item.open().read()
-		if isinstance(top_m3u, bytes):
-			top_m3u = top_m3u.decode("ascii")
+	def get_video_item(self, url):
+		# awkward because this class is designed for imagesets and not videos
+		if url.startswith("/"):
+			url = "https://video.twimg.com" + url
+		cache_key, _, _ = decode_twimg(url)
+		if cache_key not in self.media_by_url:
+			return None
+		item, _ = self.media_by_url[cache_key].get_variant(None, None)
+		return item
+
+	def read_m3u8(self, item):
+		with item.open() as f:
+			m3u = f.read()
+		if isinstance(m3u, bytes):
+			m3u = m3u.decode("ascii")
+		return m3u
+
+	def complete_variant(self, top_m3u):
+		"returns the first variant playlist for which all segments were captured"
+		get = self.get_video_item
 		sub_m3u_urls = [line for line in top_m3u.splitlines() if line and not line.startswith("#")]
 
 		for sub_m3u_url in sub_m3u_urls:
 			sub_m3u_item = get(sub_m3u_url)
 			if not sub_m3u_item:
 				continue
-			with sub_m3u_item.open() as sub_m3u_file:
-				sub_m3u = sub_m3u_file.read()
-			if isinstance(sub_m3u, bytes):
-				sub_m3u = sub_m3u.decode("ascii")
-			is_complete = True
-			for line in sub_m3u.splitlines():
-				if line and not line.startswith("#") and not get(line):
-					is_complete = False
-			if not is_complete:
-				continue
+			sub_m3u = self.read_m3u8(sub_m3u_item)
+			if all(get(url) for url in m3u8_segment_urls(sub_m3u)):
+				return sub_m3u
+
+	def remux(self, sub_m3u, wait=True):
+		get = self.get_video_item
+		item = concat_m3u8(sub_m3u, get)
+		if item:
+			return item
+		if not shutil.which("ffmpeg"):
+			return None # mpeg-ts segments can't be merged without it
+		key = self.remux_cache.key(sub_m3u, get)
+		item = self.remux_cache.get(key)
+		if item:
+			return item
+		job = self.remux_queue.submit(key, lambda out_path: merge_m3u8(sub_m3u, get, out_path))
+		if wait:
+			return job.result()
 
-			merged_video = merge_m3u8(sub_m3u, get)
-			item = InMemory(merged_video)
-			item.mime = "video/mp4"
-			return item, False
+	def lookup_video(self, url):
+		assert url
+		top_m3u_item = self.get_video_item(url.replace(".m3u8.mp4", ".m3u8"))
+		if not top_m3u_item:
+			return None, False
+		sub_m3u = self.complete_variant(self.read_m3u8(top_m3u_item))
+		if sub_m3u is None:
+			return None, False
+		return self.remux(sub_m3u), False
+
+	def preremux(self):
+		"queue remux jobs for all complete videos, without waiting for them"
+		for cache_key, videoset in list(self.media_by_url.items()):
+			if not cache_key.endswith(".m3u8") or not isinstance(videoset, VideoSet):
+				continue
+			top_m3u = self.read_m3u8(videoset.entries[0])
+			if "#EXT-X-STREAM-INF" not in top_m3u:
+				continue # a variant playlist, not a top level one
+			sub_m3u = self.complete_variant(top_m3u)
+			if sub_m3u is not None:
+				self.remux(sub_m3u, wait=False)
 
 # replace urls in tweet/user objects
 
@@ -598,65 +804,324 @@ class ZipFS:
 			if name.startswith(path) and name != path:
 				yield name[len(path):]
 
-def unscramble(likes):
-	class Node:
-		capacity = 10
-		def __init__(self, index, count):
-			self.index = index
-			self.count = count
-			self.children = []
-
-	n = len(likes)
-	new_likes = [None] * len(likes)
-
-	queue = []
-	for i in range(0, n, 25):
-		ntweets = min(n-i, 25)
-		child = Node(i, ntweets)
-		if queue:
-			parent = queue[0]
-			parent.children.append(child)
-			if len(parent.children) == parent.capacity:
-				queue.pop(0)
+word_re = re.compile(r"\w+")
+
+def words_of(text):
+	return word_re.findall(text.casefold())
+
+def page_after(ids, cursor, limit):
+	"ids sorted in descending order, returns (page, next cursor) for the page after cursor"
+	lo = 0
+	if cursor is not None:
+		# the first id below the cursor
+		lo = bisect.bisect_right(ids, -cursor, key=lambda id: -id)
+	page = ids[lo:lo+limit]
+	next_cursor = page[-1] if page and lo + limit < len(ids) else None
+	return page, next_cursor
+
+def stitch_pages(snapshots):
+	"""join /Likes pages that continue one another (by cursor_bottom and
+	continue_from) into one snapshot per scroll session"""
+	by_cursor = {}
+	for snap in snapshots:
+		cursor = getattr(snap, "cursor_bottom", None)
+		if cursor is not None:
+			by_cursor[cursor] = snap
+	next_page = {} # id(snap) -> the page loaded after it
+	for snap in snapshots:
+		prev = by_cursor.get(getattr(snap, "continue_from", None), None)
+		if prev is None or prev is snap or type(prev) is not type(snap):
+			continue
+		if id(prev) not in next_page:
+			next_page[id(prev)] = snap
+	continuing = {id(snap) for snap in next_page.values()}
+
+	stitched = []
+	done = set()
+	for snap in snapshots:
+		if id(snap) in continuing:
+			continue
+		pages = [snap]
+		done.add(id(snap))
+		while id(pages[-1]) in next_page and id(next_page[id(pages[-1])]) not in done:
+			pages.append(next_page[id(pages[-1])])
+			done.add(id(pages[-1]))
+		if len(pages) == 1:
+			stitched.append(snap)
+			continue
+		# a like between two requests shifts the list, so the next page
+		# can repeat entries. the earlier page has them right
+		seen = set()
+		if isinstance(snap, seqalign.Items):
+			items = [itid for page in pages for itid in page.items if not (itid in seen or seen.add(itid))]
+			joined = seqalign.Items(items)
 		else:
-			root = child
-			root.capacity = 9 # whyever
-		queue.append(child)
-
-	i = 0
-	def visit(node):
-		nonlocal i
-		for j in range(node.count):
-			new_likes[node.index + j] = likes[i]
-			i += 1
-		for child in node.children:
-			visit(child)
-	visit(root)
-
-	return new_likes
+			seq = [(evid, itid) for page in pages for evid, itid in page.seq if not (itid in seen or seen.add(itid))]
+			joined = seqalign.Events(seq)
+		joined.time = snap.time # when the top of the list was seen
+		joined.continue_from = getattr(snap, "continue_from", None)
+		joined.cursor_bottom = getattr(pages[-1], "cursor_bottom", None)
+		stitched.append(joined)
+
+	# pages whose cursors form a cycle
+	stitched.extend(snap for snap in snapshots if id(snap) not in done)
+	return stitched
+
+class IngestStats:
+	# where the time goes while loading: per data source (its last load), per
+	# kind of api response (summed over all loads) and per phase of
+	# sort_profiles, for /api/debug/ingest. kept across reloads, so that a slow
+	# new source or a changed response format shows up right away
+
+	def __init__(self, keep=20):
+		self.sources = {} # path -> counters
+		self.operations = {} # graphql operation or api path -> counters
+		self.reloads = collections.deque(maxlen=keep)
+		self.current = [] # the counters that work is currently added to
+		self.running = set() # timed methods that are running, to count only the outermost call
+
+	@contextlib.contextmanager
+	def counting(self, counters):
+		self.current.append(counters)
+		t0 = time.perf_counter()
+		try:
+			yield counters
+		finally:
+			self.current.pop()
+			counters["seconds"] = counters.get("seconds", 0) + time.perf_counter() - t0
+
+	def source(self, path):
+		counters = self.sources[path] = {"loads": self.sources.get(path, {}).get("loads", 0) + 1}
+		if self.reloads:
+			self.reloads[-1]["sources"].append(path)
+		return self.counting(counters)
+
+	def operation(self, name):
+		counters = self.operations.setdefault(name, {})
+		counters["count"] = counters.get("count", 0) + 1
+		return self.counting(counters)
+
+	def add(self, **amounts):
+		for counters in self.current:
+			for name, amount in amounts.items():
+				counters[name] = counters.get(name, 0) + amount
+
+	def call(self, name, f, *args, **kwargs):
+		if name in self.running:
+			return f(*args, **kwargs)
+		self.running.add(name)
+		t0 = time.perf_counter()
+		try:
+			return f(*args, **kwargs)
+		finally:
+			self.running.discard(name)
+			self.add(**{name + "_calls": 1, name + "_seconds": time.perf_counter() - t0})
+
+	def begin_reload(self):
+		self.reloads.append({"started": time.time(), "sources": [], "sort_profiles": {}})
+
+	def end_reload(self):
+		self.reloads[-1]["seconds"] = time.time() - self.reloads[-1]["started"]
+
+	def phases(self):
+		"returns a function to call with the name of each phase when it's done"
+		phases = self.reloads[-1]["sort_profiles"] if self.reloads else {}
+		t = [time.perf_counter()]
+		def phase(name):
+			now = time.perf_counter()
+			phases[name] = phases.get(name, 0) + now - t[0]
+			t[0] = now
+		return phase
+
+def ingest_timed(f):
+	"count the time spent in a DB method to the source and operation being loaded"
+	@functools.wraps(f)
+	def timed(self, *args, **kwargs):
+		return self.ingest.call(f.__name__, f, self, *args, **kwargs)
+	return timed
+
+# shapes that add_tweet knows
+visibility_results_keys = {
+	frozenset({"__typename", "tweet", "limitedActionResults"}),
+	frozenset({"__typename", "tweet", "tweetInterstitial"}),
+	frozenset({"__typename", "tweet", "limitedActionResults", "tweetInterstitial"}),
+	frozenset({"__typename", "tweet", "limitedActionResults", "softInterventionPivot"}),
+	frozenset({"__typename", "tweet", "mediaVisibilityResults"}),
+	frozenset({"__typename", "tweet", "limitedActionResults", "mediaVisibilityResults"})
+}
+card_names = {"player", "summary", "summary_large_image", "promo_image_convo", "poll2choice_text_only",
+	"poll3choice_text_only", "poll4choice_text_only", "unified_card", "promo_video_convo", "amplify"}
+card_name_suffixes = (":live_event", ":broadcast", ":message_me", ":audiospace")
+
+gql_handlers = {} # graphql operation name -> DB method that loads its responses
+
+def gql(*operations):
+	"registers a DB method as the loader of these graphql operations"
+	def register(f):
+		for operation in operations:
+			gql_handlers[operation] = f
+		return f
+	return register
+
+# operations that are known, but have nothing to load
+gql_ignored = {
+	"GetUserClaims",
+	"DataSaverMode",
+	"CommunitiesTabBarItemQuery",
+	"ProfileSpotlightsQuery", # has data["user_result_by_screen_name"]["result"] for add_user
+	"FetchDraftTweets", # {"viewer":{"draft_list":{"response_data":[]}}} or drafts
+	"FavoriteTweet",
+	"UnfavoriteTweet",
+	"AudioSpaceById",
+
+	# todo
+	"CreateRetweet",
+	"FollowersYouKnow",
+	"BlueVerifiedFollowers",
+	"CreateBookmark",
+	"articleNudgeDomains",
+	"useFetchProfileBlocks_profileExistsQuery",
+	"PinnedTimelines",
+	"ExploreSidebar",
+	"ExplorePage",
+	"UserPreferences",
+	"useTypingNotifierMutation",
+	"AccountSwitcherDelegateQuery",
+	"DelegatedAccountListQuery",
+	"SensitiveMediaSettingsQuery",
+	"fetchDownloadSettingAllowedQuery",
+	"ListsManagementPageTimeline",
+	"ListLatestTweetsTimeline",
+	"BroadcastQuery",
+	"PutClientEducationFlag",
+	"ConnectTabTimeline",
+	"TweetResultByRestId",
+	"ModeratedTimeline",
+	"PremiumSignUpQuery",
+	"useSubscriptionProductDetailsQuery",
+	"ListProductSubscriptions",
+	"CommunitiesCreateButtonQuery",
+	"CarouselQuery",
+	"CommunitiesMainPageTimeline",
+	"RemoveFollower",
+	"ListOwnerships",
+	"ListAddMember",
+	"DeleteTweet",
+	"ConversationControlChange",
+	"DeleteRetweet",
+	"PinTweet",
+	"UnpinTweet",
+	"useDMReactionMutationAddMutation",
+	"DeleteBookmark",
+	"CommunitiesFetchOneQuery",
+	"BlueVerifiedProfileEditCalloutQuery",
+	"ReportDetailQuery",
+	"BirdwatchFetchAuthenticatedUserProfile",
+	"BirdwatchFetchOneNote",
+	"BirdwatchFetchAliasSelfSelectStatus",
+	"BirdwatchFetchNotes",
+	"usePricesQuery",
+	"useVerifiedOrgFeatureHelperQuery",
+	"useProductSkuQuery",
+	"TranslationFeedbackProvideFeedbackMutation",
+	"UserHighlightsTweets",
+	"UserAccountLabel",
+	"GenericTimelineById",
+	"BookmarkSearchTimeline",
+	"useRelayDelegateDataPendingQuery",
+	"TrendRelevantUsers",
+	"AiTrendByRestId",
+	"FollowHostButtonQuery",
+	"useFetchAnalyticsQuery",
+	"AuthenticatePeriscope",
+	"QuickPromoteEligibility",
+	"TweetActivityQuery",
+	"PremiumContentQuery",
+	"SubscriptionProductDetails",
+	"useFetchProfileSections_profileQuery",
+	"GrokHome",
+	"Viewer",
+	"ViewerUserQuery",
+	"affiliatesQuery",
+	"BenefitsBadgeCardQuery",
+	"CreateGrokConversation",
+	"useFetchProfileSections_canViewExpandedProfileQuery",
+	"SupportedLanguages",
+	"GetGrokCustomizationSettingQuery",
+	"feedbackMutation",
+	"personalityHooksAllPersonalitiesQuery",
+	"TopicCarouselQuery",
+	"CommunitiesRankedTimeline",
+	"CommunitiesExploreTimeline",
+	"isEligibleForVoButtonUpsellQuery",
+	"GrokHistory",
+	"GrokConversationItemsByRestId",
+	"isEligibleForAnalyticsUpsellQuery",
+	"SidebarUserRecommendations",
+	"NotificationsTimeline",
+	"DmAllSearchSlice",
+	"useFetchProfileSections_profileSectionsCountQuery",
+	"useStoryTopicQuery",
+	"VOCardsQuery",
+	"useTotalAdCampaignsForUserQuery",
+	"useUpsellTrackingMutation",
+	"CommunityQuery",
+}
 
 class DB:
-	def __init__(self):
-		self.tweets = {}
-		self.replies = {}
-		self.profiles = {}
+	def __init__(self, storage=None, data_dir=".", freezer=None):
+		self.storage = storage # a storage.SqliteStore, or None to keep everything in memory
+		if storage:
+			self.tweets = storage.table("tweets", Tweet)
+			self.replies = storage.table("replies")
+			self.profiles = storage.table("profiles", Profile)
+			self.conversations = storage.table("conversations")
+		else:
+			self.tweets = RecordTable(Tweet, freezer) # freezer compresses tweets that weren't used in a while
+			self.replies = {} # twid -> sorted twids of direct replies
+			self.profiles = RecordTable(Profile)
+			self.conversations = {}
 		self.followers = {} # could be part of .profiles
 		self.followings = {} # could be part of .profiles
 		self.user_by_handle = {}
-		self.media = MediaStore()
-		self.har = HarStore("harstore")
+		self.user_by_name = {} # display names, including former ones
+		self.follows_dirty = set() # uids with new followers or followings
+		self.media = MediaStore(data_dir)
+		self.har = HarStore(os.path.join(data_dir, "harstore"))
 		self.warc_responses = {} # to allow warc references across files
 		self.likes_snapshots = {}
 		self.likes_unsorted = {}
+		self.likes_history = {} # uid -> seqalign.History
+		self.likes_pending = {} # uid -> snapshots not in likes_history yet
+		self.likes_dirty = set() # uids with new likes_unsorted entries
+		self.likes_seen = set() # to skip snapshots from files that are read again
+		self.likes_cursors = {} # uid -> cursor_bottom of pages in likes_history
 		self.bookmarks_map = {}
 		self.observers = set()
-		self.conversations = {}
+		self.added_by_source = {} # path -> table -> entries added while loading it
+		self.ingest = IngestStats()
+		self.gql_unknown = collections.Counter() # graphql responses without a loader, by operation (all are in ingest.operations)
+		self.dm_messages = {} # message id -> (cid, message)
+		self.dm_index = {} # word -> message ids
 
 		# indices
 		self.by_user = None
+		self.originals_by_user = None # by_user without replies
+		self.media_by_user = None # by_user with own media only
 		self.likes_sorted = None
 		self.bookmarks_sorted = None
 		self.interactions_sorted = None
+		self.conversations_sorted = None
+		self.followers_sorted = {} # uid -> follower uids, descending
+		self.everyone_ranked = None # uids with at least two tweets, most tweets first
+		self.everyone_index_keys = [] # sorted casefolded handles and names of everyone_ranked
+		self.everyone_index_ranks = [] # their positions in everyone_ranked
+		self.everyone_by_prefix = {} # prefix -> sorted positions of matches, until the next sort_profiles
+		self.user_by_folded_handle = None
+		self.user_index_keys = None # casefolded handles and names, sorted
+		self.user_index_uids = None # uid for each of user_index_keys
+		self.user_index_tweets = None # tweet count of each of user_index_uids, to rank suggestions by
+		self.followings_sorted = {}
 
 		# context
 		self.time = None
@@ -666,8 +1131,10 @@ class DB:
 		self.ignore_urls = set()
 
 	def sort_profiles(self):
+		phase = self.ingest.phases()
 		self.by_user = {}
-		self.likes_sorted = {}
+		if self.likes_sorted is None:
+			self.likes_sorted = {} # kept across reloads, see below
 		self.bookmarks_sorted = {}
 		self.interactions_sorted = {}
 
@@ -676,61 +1143,131 @@ class DB:
 			uid = tweet.get("user_id_str", None)
 			if uid is not None:
 				self.by_user.setdefault(int(uid), []).append(twid)
+		phase("by user")
 
 		# tweets in reverse chronological order
 		for tids in self.by_user.values():
 			tids[:] = set(tids)
 			tids.sort(key=lambda twid: -twid)
+		phase("sort by user")
+
+		# the directory, by number of tweets
+		ranking = [(-len(tids), uid) for uid, tids in self.by_user.items() if len(tids) >= 2 and uid in self.profiles]
+		ranking.sort()
+		self.everyone_ranked = [uid for neg_num_tweets, uid in ranking]
+		index = set()
+		for rank, uid in enumerate(self.everyone_ranked):
+			profile = self.profiles[uid]
+			index.add((profile.get("screen_name", "").casefold(), rank))
+			index.add((profile.get("name", "").casefold(), rank))
+		index = sorted(index)
+		self.everyone_index_keys = [key for key, rank in index]
+		self.everyone_index_ranks = [rank for key, rank in index]
+		self.everyone_by_prefix = {}
+		phase("directory")
+
+		# handles and names for lookups by prefix
+		self.user_by_folded_handle = {}
+		for handle, uids in self.user_by_handle.items():
+			self.user_by_folded_handle.setdefault(handle.casefold(), set()).update(uids)
+		index = set()
+		for by_key in (self.user_by_handle, self.user_by_name):
+			for key, uids in by_key.items():
+				key = key.casefold()
+				for uid in uids:
+					index.add((key, uid))
+		index = sorted(index)
+		self.user_index_keys = [key for key, uid in index]
+		self.user_index_uids = [uid for key, uid in index]
+		tweet_counts = {uid: len(self.by_user.get(uid, [])) for uid in set(self.user_index_uids)}
+		self.user_index_tweets = [tweet_counts[uid] for uid in self.user_index_uids]
+		phase("user index")
+
+		# the profile and media tabs
+		self.originals_by_user = {}
+		self.media_by_user = {}
+		for uid, tids in self.by_user.items():
+			originals = []
+			media = []
+			for twid in tids:
+				tweet = self.tweets.peek(twid) # index passes shouldn't count as uses for the freezer
+				if "in_reply_to_status_id_str" not in tweet:
+					originals.append(twid)
+				if tweet.is_cold("entities") or len(tweet.get("entities", {}).get("media", [])) == 0:
+					continue # entities with media are never frozen
+				otweet = self.tweets.peek(tweet["original_id"], tweet)
+				if int(otweet["user_id_str"]) == uid:
+					media.append(twid)
+			if originals:
+				self.originals_by_user[uid] = originals
+			if media:
+				self.media_by_user[uid] = media
+
+		if self.storage:
+			# built in memory, then only kept in the store
+			self.by_user = self.storage.replace("by_user", self.by_user.items())
+			self.originals_by_user = self.storage.replace("originals_by_user", self.originals_by_user.items())
+			self.media_by_user = self.storage.replace("media_by_user", self.media_by_user.items())
+		phase("profile tabs")
 
 		# likes in reverse chronological order
+		evid_lower_bound_for_itid = lambda twid: ((twid >> 22) + 1288834974657) << 20
 		for uid in set(self.likes_snapshots.keys()) | set(self.likes_unsorted.keys()):
-			likes_snapshots = self.likes_snapshots.get(uid, [])
-			likes_snapshots = sorted(likes_snapshots, key=lambda snap: -snap.time)
-			if False:
-				continue_index = {}
-				for snap in likes_snapshots:
-					if hasattr(snap, "cursor_bottom"):
-						continue_index[snap.cursor_bottom] = snap
-				for snap in likes_snapshots:
-					if hasattr(snap, "continue_from"):
-						from_snap = continue_index.get(snap.continue_from, None)
-						if isinstance(from_snap, seqalign.Items) and isinstance(snap, seqalign.Items):
-							from_snap.items = from_snap.items + snap.items
-							snap.items = None
-						else:
-							del snap.continue_from
-				likes_snapshots = [snap for snap in likes_snapshots if not hasattr(snap, "continue_from")]
-
-			l = seqalign.align(
-				likes_snapshots,
-				evid_lower_bound_for_itid=lambda twid: ((twid >> 22) + 1288834974657) << 20
-			)
-
-			# 
-			have_twid = set()
-			for sort_index, twid in l:
-				tweet = self.tweets.get(twid, {})
-				original_id = tweet.get("original_id", twid)
-				have_twid.add(original_id)
-
-			for twid in self.likes_unsorted.get(uid, []):
-				tweet = self.tweets[twid]
-				twid = tweet["original_id"]
-				if tweet["original_id"] in have_twid:
-					continue
-				have_twid.add(twid)
-				timestamp = (twid >> 22) + 1288834974657
-				synthesized_like_id = timestamp << 20
-				l.append((synthesized_like_id, twid))
+			pending = self.likes_pending.pop(uid, [])
+			if uid in self.likes_sorted and not pending and uid not in self.likes_dirty:
+				continue
 
-			l.sort(key=lambda a: -a[0])
-			self.likes_sorted[uid] = l
+			history = self.likes_history.get(uid, None)
+			cursors = self.likes_cursors.setdefault(uid, set())
+			pages = pending
+			pending = stitch_pages(pages)
+			folded = history is not None and all(
+				snap.time >= history.time and getattr(snap, "continue_from", None) not in cursors
+				for snap in pending
+			)
+			if folded:
+				# only newer captures that don't continue an earlier page, fold
+				# them in where that gives what a full align would
+				for snap in sorted(pending, key=lambda snap: snap.time):
+					if not history.fold(snap):
+						folded = False
+						break
+
+			if not folded and uid in self.likes_snapshots:
+				likes_snapshots = stitch_pages(self.likes_snapshots[uid])
+				likes_snapshots.sort(key=lambda snap: -snap.time)
+				history = self.likes_history[uid] = seqalign.History(
+					seqalign.align(
+						likes_snapshots,
+						evid_lower_bound_for_itid=evid_lower_bound_for_itid
+					),
+					likes_snapshots[0].time
+				)
+				pages = self.likes_snapshots[uid]
+
+			for snap in pages:
+				cursor = getattr(snap, "cursor_bottom", None)
+				if cursor is not None:
+					cursors.add(cursor)
+
+			# likes seen elsewhere, without a like id. a liked retweet stands
+			# for its original
+			unsorted = [self.tweets.peek(twid)["original_id"] for twid in self.likes_unsorted.get(uid, [])]
+			self.likes_sorted[uid] = seqalign.add_unordered(
+				history.items if history is not None else [],
+				unsorted,
+				evid_lower_bound_for_itid,
+				lambda twid: self.tweets.peek(twid, {}).get("original_id", twid)
+			)
+		self.likes_dirty.clear()
+		phase("likes")
 
 		# bookmarks in reverse chronological order
 		for uid, bookmarks in self.bookmarks_map.items():
 			l = sorted(bookmarks.items(), key=lambda a: -a[1])
 			l = [(sort_index, twid) for twid, sort_index in l]
 			self.bookmarks_sorted[uid] = l
+		phase("bookmarks")
 
 		# replies hint at followings
 		for twid, tweet in self.tweets.items():
@@ -740,25 +1277,39 @@ class DB:
 				if b in self.profiles and self.profiles[b].get("protected", False):
 					if a != b:
 						self.add_follow(a, b)
+		phase("follows from replies")
+
+		# followers and followings by descending id, for paging
+		for uid in self.follows_dirty:
+			if uid in self.followers:
+				self.followers_sorted[uid] = sorted(self.followers[uid], reverse=True)
+			if uid in self.followings:
+				self.followings_sorted[uid] = sorted(self.followings[uid], reverse=True)
+		self.follows_dirty.clear()
+		phase("follows")
 
 		# likes are interactions
 		for uid, likes in self.likes_sorted.items():
 			if uid in self.observers:
 				for likeid, twid in likes:
 					if twid in self.tweets:
-						tweet = self.tweets[twid]
+						tweet = self.tweets.peek(twid)
 						if "user_id_str" in tweet:
 							u = int(tweet["user_id_str"])
 							self.interactions_sorted.setdefault(u, []).append(twid)
+		phase("interactions")
 
 		# interactions in reverse chronological order
 		for tids in self.interactions_sorted.values():
 			tids[:] = set(tids)
 			tids.sort(key=lambda twid: -twid)
+		phase("sort interactions")
 
-		# sort dm messages
-		for c in self.conversations.values():
-			c["messages"].sort(key=lambda m: -int(m.get("messageCreate", {}).get("id", 0)))
+		# dm conversations by their last message, messages are kept sorted on insert
+		conversations = [(c["message_keys"][0], cid) for cid, c in self.conversations.items() if c["messages"]]
+		conversations.sort()
+		self.conversations_sorted = [cid for key, cid in conversations]
+		phase("conversations")
 
 		# generally all tweets in a conversation need to belong to the same circle
 		for twid, tweet in self.tweets.items():
@@ -766,7 +1317,7 @@ class DB:
 				continue
 			if "conversation_id_str" in tweet:
 				ctwid = int(tweet["conversation_id_str"])
-				ctweet = self.tweets.get(ctwid, None)
+				ctweet = self.tweets.peek(ctwid, None)
 				if ctweet:
 					if "limited_actions" in ctweet and "limited_actions" not in tweet:
 						print("inferred that", twid, "must have limited actions")
@@ -784,31 +1335,129 @@ class DB:
 									"user": user["name"]
 								}
 								print("inferred that", twid, "must belong to", user["screen_name"]+"'s", "circle")
+		phase("circles")
+
+	def add_likes_snapshot(self, uid, snapshot):
+		if isinstance(snapshot, seqalign.Events):
+			content = repr(("events", snapshot.seq))
+		else:
+			content = repr(("items", snapshot.items))
+		key = (uid, snapshot.time, hashlib.sha1(content.encode("utf-8")).digest())
+		if key in self.likes_seen:
+			return
+		self.likes_seen.add(key)
+		self.likes_snapshots.setdefault(uid, []).append(snapshot)
+		self.likes_pending.setdefault(uid, []).append(snapshot)
+
+	def add_unsorted_like(self, uid, twid):
+		likes = self.likes_unsorted.setdefault(uid, set())
+		if twid not in likes:
+			likes.add(twid)
+			self.likes_dirty.add(uid)
 
 	# queries
 
 	def get_user_tweets(self, uid):
 		pinned_tweet = [int(twid_str) for twid_str in self.profiles.get(uid, {}).get("pinned_tweet_ids_str", [])]
-		regular_tweets = [twid for twid in self.by_user.get(uid, []) if
-			"in_reply_to_status_id_str" not in self.tweets.get(twid, {})
-		]
-		return pinned_tweet + regular_tweets
+		return pinned_tweet + self.originals_by_user.get(uid, [])
 
 	def get_user_with_replies(self, uid):
 		return self.by_user.get(uid, [])
 
 	def get_user_media(self, uid):
-		media_tweets = []
-		for twid in self.by_user.get(uid, []):
-			tweet = self.tweets.get(twid, {})
-			if len(tweet.get("entities", {}).get("media", [])) == 0:
-				continue
-			otwid = tweet["original_id"]
-			tweet = self.tweets.get(otwid, tweet)
-			if int(tweet["user_id_str"]) != uid:
-				continue
-			media_tweets.append(twid)
-		return media_tweets
+		return self.media_by_user.get(uid, [])
+
+	def get_everyone(self, prefix=None, cursor=0, limit=300):
+		"returns (uids, next cursor), the cursor being a position in everyone_ranked"
+		ranking = self.everyone_ranked
+		if not prefix:
+			page = ranking[cursor:cursor+limit]
+			i = cursor + len(page)
+			return page, (i if i < len(ranking) else None)
+		ranks = self.everyone_matching(prefix.casefold())
+		j = bisect.bisect_left(ranks, cursor)
+		page = ranks[j:j+limit]
+		return [ranking[rank] for rank in page], (page[-1] + 1 if j + limit < len(ranks) else None)
+
+	def everyone_matching(self, prefix):
+		"sorted positions in everyone_ranked of users whose handle or name starts with prefix"
+		ranks = self.everyone_by_prefix.get(prefix, None)
+		if ranks is None:
+			keys = self.everyone_index_keys
+			lo = bisect.bisect_left(keys, prefix)
+			hi = lo
+			while hi < len(keys) and keys[hi].startswith(prefix):
+				hi += 1
+			ranks = sorted(set(self.everyone_index_ranks[lo:hi]))
+			if len(self.everyone_by_prefix) >= 1000:
+				self.everyone_by_prefix.clear()
+			self.everyone_by_prefix[prefix] = ranks
+		return ranks
+
+	def find_users(self, handle):
+		"uids for a handle, falling back to a case-insensitive match"
+		uids = self.user_by_handle.get(handle, None)
+		if uids:
+			return uids
+		return self.user_by_folded_handle.get(handle.casefold(), set())
+
+	def suggest_users(self, prefix, limit=10):
+		"uids whose handle or name (current or former) starts with prefix, most tweets first"
+		prefix = prefix.lstrip("@").casefold()
+		if not prefix:
+			return []
+		keys = self.user_index_keys
+		ranked = {} # uid -> (tweets, -uid)
+		i = bisect.bisect_left(keys, prefix)
+		while i < len(keys) and keys[i].startswith(prefix):
+			uid = self.user_index_uids[i]
+			ranked[uid] = (self.user_index_tweets[i], -uid)
+			i += 1
+		return heapq.nlargest(limit, ranked, key=ranked.__getitem__)
+
+	def get_conversations(self, cursor=0, limit=300):
+		"returns (cids, next cursor), the cursor being a position in conversations_sorted"
+		page = self.conversations_sorted[cursor:cursor+limit]
+		i = cursor + len(page)
+		return page, (i if i < len(self.conversations_sorted) else None)
+
+	def get_messages(self, cid, cursor=None, limit=300):
+		"returns (messages, next cursor), most recent first, starting below message id cursor"
+		c = self.conversations[cid]
+		i = 0 if cursor is None else bisect.bisect_right(c["message_keys"], -cursor)
+		page = c["messages"][i:i+limit]
+		next_cursor = -c["message_keys"][i+limit-1] if page and i + limit < len(c["messages"]) else None
+		return page, next_cursor
+
+	def index_message(self, cid, mid, message):
+		mc = message["messageCreate"]
+		self.dm_messages[mid] = (cid, message)
+		words = set(words_of(mc.get("text", "")))
+		for url in mc.get("urls", []):
+			words.update(words_of(url.get("expanded", None) or url.get("url", "")))
+		for word in words:
+			self.dm_index.setdefault(word, set()).add(mid)
+
+	def search_messages(self, query, cid=None, sender=None, cursor=None, limit=100):
+		"returns ([(cid, message)], next cursor) for messages containing all words of query, most recent first"
+		words = set(words_of(query))
+		if not words:
+			return [], None
+		postings = sorted((self.dm_index.get(word, set()) for word in words), key=len)
+		mids = postings[0].intersection(*postings[1:])
+		if cid is not None or sender is not None:
+			mids = [mid for mid in mids if
+				(cid is None or self.dm_messages[mid][0] == cid) and
+				(sender is None or self.dm_messages[mid][1]["messageCreate"].get("senderId", None) == sender)]
+		mids = sorted(mids, reverse=True)
+		page, cursor = page_after(mids, cursor, limit)
+		return [self.dm_messages[mid] for mid in page], cursor
+
+	def get_followers(self, uid, cursor=None, limit=300):
+		return page_after(self.followers_sorted.get(uid, []), cursor, limit)
+
+	def get_followings(self, uid, cursor=None, limit=300):
+		return page_after(self.followings_sorted.get(uid, []), cursor, limit)
 
 	def get_user_likes(self, uid):
 		return self.likes_sorted.get(uid, [])
@@ -826,8 +1475,8 @@ class DB:
 			twid for twid, tweet in self.tweets.items()
 			# 1. match full-text
 			# 2. match media urls
-			if all(word in tweet.get("full_text", "") for word in words)
-			or any(query in media["media_url_https"] for media in tweet.get("extended_entities", {}).get("media", []))
+			if all(word in tweet.get("full_text", "") for word in words) # never frozen
+			or any(query in url for url in tweet_media_urls(tweet))
 		}
 
 	# twitter archives
@@ -837,7 +1486,15 @@ class DB:
 			prefix = f.read(len(expected_prefix))
 			if isinstance(prefix, bytes): prefix = prefix.decode("utf-8")
 			assert prefix == expected_prefix, (prefix, expected_prefix)
-			return json.load(f, **json_load_args)
+			return self.parse_json(f)
+
+	def parse_json(self, f):
+		"json.load, counting size and time for /api/debug/ingest"
+		t0 = time.perf_counter()
+		raw = f.read()
+		data = json.loads(raw, **json_load_args)
+		self.ingest.add(records=1, bytes=len(raw), json_seconds=time.perf_counter() - t0)
+		return data
 
 	def load(self, base):
 		if not isinstance(base, str):
@@ -924,7 +1581,7 @@ class DB:
 
 		like_twids = []
 
-		likes = unscramble(likes)
+		likes = seqalign.unscramble(likes)
 
 		for like in likes:
 			like = like["like"]
@@ -948,7 +1605,7 @@ class DB:
 
 		snapshot = seqalign.Items(like_twids)
 		snapshot.time = self.time
-		self.likes_snapshots.setdefault(self.uid, []).append(snapshot)
+		self.add_likes_snapshot(self.uid, snapshot)
 
 		# no merging happening yet
 		conversations = self.load_with_prefix(fs, "direct-messages.js", "window.YTD.direct_messages.part0 = ")
@@ -986,10 +1643,12 @@ class DB:
 			c = c["dmConversation"]
 			cid = c["conversationId"]
 			ic = self.conversations.setdefault(cid, {
-				"messages": [],
+				"messages": [], # most recent first
+				"message_keys": [], # -id of each message, for bisect
 				"message_ids": set()
 			})
 			icm = ic["messages"]
+			icmk = ic["message_keys"]
 			icmi = ic["message_ids"]
 			for message in c["messages"]:
 				try:
@@ -998,8 +1657,11 @@ class DB:
 					continue
 				if mid in icmi:
 					continue
-				icm.append(message)
+				i = bisect.bisect_right(icmk, -mid) # usually the end, archives list newest first
+				icm.insert(i, message)
+				icmk.insert(i, -mid)
 				icmi.add(mid)
+				self.index_message(cid, mid, message)
 
 		if tweets_media:
 			self.media.add_from_archive(fs, tweets_media)
@@ -1102,7 +1764,8 @@ class DB:
 			self.tweets[twid].update(tweet)
 			dbtweet = self.tweets[twid]
 		else:
-			dbtweet = self.tweets[twid] = tweet
+			self.tweets[twid] = tweet
+			dbtweet = self.tweets[twid]
 		if self.uid:
 			observer = str(self.uid)
 			if bookmarked:
@@ -1111,14 +1774,15 @@ class DB:
 			if favorited:
 				g = dbtweet.setdefault("favoriters", [])
 				if observer not in g: g.append(observer)
-				self.likes_unsorted.setdefault(self.uid, set()).add(twid) # unknown like
+				self.add_unsorted_like(self.uid, twid) # unknown like
 			if retweeted:
 				g = dbtweet.setdefault("retweeters", [])
 				if observer not in g: g.append(observer)
 		if "in_reply_to_status_id_str" in tweet:
 			rtwid = int(tweet["in_reply_to_status_id_str"])
 			r = self.replies.setdefault(rtwid, [])
-			if twid not in r: r.append(twid)
+			i = bisect.bisect_left(r, twid)
+			if i == len(r) or r[i] != twid: r.insert(i, twid)
 		uid = int(tweet["user_id_str"])
 
 	def add_legacy_tweet_2019(self, tweet):
@@ -1148,6 +1812,8 @@ class DB:
 
 		if "screen_name" in user:
 			self.user_by_handle.setdefault(user["screen_name"], set()).add(uid)
+		if user.get("name", None):
+			self.user_by_name.setdefault(user["name"], set()).add(uid)
 
 		if self.uid is not None and user.get("following", False):
 			self.add_follow(self.uid, uid)
@@ -1177,19 +1843,13 @@ class DB:
 				assert key in ("created_at", "name", "screen_name"), "unfamiliar core attribute: "+key
 				dbuser[key] = value
 
+	@ingest_timed
 	def add_tweet(self, tweet):
-		heuristically_circle_tweet = False
+		limited_action_results = None
 		tn = tweet.get("__typename", None)
 		if tn == "TweetWithVisibilityResults":
-			assert frozenset(tweet.keys()) in {
-				frozenset({"__typename", "tweet", "limitedActionResults"}),
-				frozenset({"__typename", "tweet", "tweetInterstitial"}),
-				frozenset({"__typename", "tweet", "limitedActionResults", "tweetInterstitial"}),
-				frozenset({"__typename", "tweet", "limitedActionResults", "softInterventionPivot"}),
-				frozenset({"__typename", "tweet", "mediaVisibilityResults"}),
-				frozenset({"__typename", "tweet", "limitedActionResults", "mediaVisibilityResults"})
-			}, json.dumps(tweet)
-			heuristically_circle_tweet = "Circle" in json.dumps(tweet.get("limitedActionResults"))
+			assert frozenset(tweet.keys()) in visibility_results_keys, json.dumps(tweet)
+			limited_action_results = tweet.get("limitedActionResults", None)
 			tweet = tweet["tweet"]
 		elif tn == "TweetTombstone":
 			return
@@ -1205,12 +1865,7 @@ class DB:
 		legacy = tweet["legacy"]
 		if card and "legacy" in card:
 			card = card["legacy"]
-			assert card["name"] in ("player", "summary", "summary_large_image", "promo_image_convo", "poll2choice_text_only",
-				"poll3choice_text_only", "poll4choice_text_only", "unified_card", "promo_video_convo", "amplify") or \
-				card["name"].endswith(":live_event") or \
-				card["name"].endswith(":broadcast") or \
-				card["name"].endswith(":message_me") or \
-				card["name"].endswith(":audiospace"), (tweet, card, card["name"])
+			assert card["name"] in card_names or card["name"].endswith(card_name_suffixes), (tweet, card, card["name"])
 			card["binding_values"] = {
 				keyvalue["key"]: keyvalue["value"]
 				for keyvalue in card["binding_values"]
@@ -1254,7 +1909,8 @@ class DB:
 			assert "circle" not in legacy, "overwriting something"
 			legacy["circle"] = trusted_friends
 
-		elif legacy.get("limited_actions") != "limit_trusted_friends_tweet" and heuristically_circle_tweet:
+		elif legacy.get("limited_actions") != "limit_trusted_friends_tweet" and limited_action_results and \
+			"Circle" in json.dumps(limited_action_results):
 			# close call
 			print("no machine readable way to tell that", legacy["id_str"], "was a circle tweet")
 			legacy["limited_actions"] = "limit_trusted_friends_tweet"
@@ -1266,8 +1922,14 @@ class DB:
 
 	def add_follow(self, follower, following):
 		assert follower != following
-		self.followers.setdefault(following, set()).add(follower)
-		self.followings.setdefault(follower, set()).add(following)
+		followers = self.followers.setdefault(following, set())
+		if follower not in followers:
+			followers.add(follower)
+			self.follows_dirty.add(following)
+		followings = self.followings.setdefault(follower, set())
+		if following not in followings:
+			followings.add(following)
+			self.follows_dirty.add(follower)
 
 	def add_item_content(self, content, name, cursors=None):
 		ct = content["__typename"]
@@ -1424,343 +2086,194 @@ class DB:
 
 		self.toplevel = data
 		data = data["data"]
-		if path.endswith("/GetUserClaims"):
-			pass
-		elif path.endswith("/DataSaverMode"):
-			pass
-		elif path.endswith("/CommunitiesTabBarItemQuery"):
-			pass
-		elif path.endswith("/ListPins"):
-			viewer = data["viewer"]
-			for list_ in viewer.get("pinned_lists", []):
-				self.add_list(list_)
-		elif path.endswith("/DMPinnedInboxQuery"):
-			assert data == {"labeled_conversation_slice":{"items":[],"slice_info":{}}}
-		elif path.endswith("/UserByRestId"):
-			if "result" in data["user"]:
-				self.add_user(data["user"]["result"])
-		elif path.endswith("/UserByScreenName"):
-			if data == {}:
-				return
+		operation = path.rsplit("/", 1)[-1]
+		handler = gql_handlers.get(operation, None)
+		if handler:
+			handler(self, data, context)
+		elif operation not in gql_ignored:
+			# new endpoints shouldn't stop the rest from loading
+			print("unknown operation", path)
+			self.gql_unknown[operation] += 1
+
+	@gql("ListPins")
+	def gql_ListPins(self, data, context):
+		viewer = data["viewer"]
+		for list_ in viewer.get("pinned_lists", []):
+			self.add_list(list_)
+
+	@gql("DMPinnedInboxQuery")
+	def gql_DMPinnedInboxQuery(self, data, context):
+		assert data == {"labeled_conversation_slice":{"items":[],"slice_info":{}}}
+
+	@gql("UserByRestId")
+	def gql_UserByRestId(self, data, context):
+		if "result" in data["user"]:
 			self.add_user(data["user"]["result"])
-		elif path.endswith("/HomeLatestTimeline"):
-			if "home" in data:
-				if "home_timeline_urt" in data["home"]:
-					self.add_with_instructions(data["home"]["home_timeline_urt"])
-		elif path.endswith("/HomeTimeline"):
-			self.add_with_instructions(data["home"]["home_timeline_urt"])
-		elif path.endswith("/TweetDetail"):
-			if data == {}:
-				return
-			self.add_with_instructions(data["threaded_conversation_with_injections_v2"])
-		elif path.endswith("/ProfileSpotlightsQuery"):
-			#self.add_user(data["user_result_by_screen_name"]["result"])
-			pass
-		elif path.endswith("/UserTweets"):
-			tweet_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
-			if "errors" in self.toplevel and "timeline" not in tweet_timeline:
-				return
-			self.add_with_instructions(tweet_timeline["timeline"])
-		elif path.endswith("/UserTweetsAndReplies"):
-			tweet_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
-			self.add_with_instructions(tweet_timeline["timeline"])
-		elif path.endswith("/UserMedia"):
-			media_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
-			if media_timeline == {}:
-				return
-			self.add_with_instructions(media_timeline["timeline"])
-		elif path.endswith("/Likes"):
-			gql_vars = self.get_gql_vars(context) or {}
-			whose_likes = int(gql_vars["userId"])
-			likes_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
-			layout, cursors = self.add_with_instructions(likes_timeline["timeline"])
-
-			likes = []
-			for entry in layout:
-				if entry is None:
-					continue # non-tweet timeline item
-				sort_index, name, twid = entry
-				if twid is None:
-					continue # tweet deleted or on locked account
-				assert isinstance(twid, int)
-				likes.append((sort_index, twid))
-			cursors = [(cname, cdata["value"]) for cname, cdata in cursors]
-
-			if not likes:
-				return
 
-			if len(likes) > 1 and likes[0][0] != likes[1][0]+1:
-				snapshot = seqalign.Events(likes)
-			else:
-				snapshot = seqalign.Items([twid for sort_index, twid in likes])
-			snapshot.time = self.time
-			snapshot.continue_from = gql_vars.get("cursor", None)
-			for cname, value in cursors:
-				if cname.startswith("cursor-bottom-"):
-					snapshot.cursor_bottom = value
-					break
-			del cname, value
-
-			snapshots = self.likes_snapshots.setdefault(whose_likes, [])
-			snapshots.append(snapshot)
-
-		elif path.endswith("/Bookmarks"):
-			layout, cursors = self.add_with_instructions(data["bookmark_timeline_v2"]["timeline"])
-			user_bookmarks = self.bookmarks_map.setdefault(self.uid, {})
-			for entry in layout:
-				if entry is None:
-					continue # non-tweet timeline item
-				sort_index, name, twid = entry
-				if twid is None:
-					continue # tweet deleted or on locked account
-				assert isinstance(twid, int)
-				user_bookmarks[twid] = max(sort_index, user_bookmarks.get(twid, sort_index))
-
-		elif path.endswith("/Following"):
-			gql_vars = self.get_gql_vars(context) or {}
-			whose_followings = int(gql_vars["userId"])
-			followings_timeline = self.add_user(data["user"]["result"], give_timeline_v1=True)
-			layout, cursors = self.add_with_instructions(followings_timeline["timeline"])
-			for entry in layout:
-				if entry is None:
-					continue
-				sort_index, name, following_uid = entry
-				self.add_follow(whose_followings, following_uid)
-
-		elif path.endswith("/Followers"):
-			gql_vars = self.get_gql_vars(context) or {}
-			whose_followers = int(gql_vars["userId"])
-			followers_timeline = self.add_user(data["user"]["result"], give_timeline_v1=True)
-			layout, cursors = self.add_with_instructions(followers_timeline["timeline"])
-			for entry in layout:
-				if entry is None:
-					continue
-				sort_index, name, follower_uid = entry
-				self.add_follow(follower_uid, whose_followers)
-
-		elif path.endswith("/UsersVerifiedAvatars"):
-			for result in data["usersResults"]:
-				self.add_user(result["result"])
-		elif path.endswith("/getAltTextPromptPreference"):
-			assert data == {}
-		elif path.endswith("/Favoriters"):
-			self.add_with_instructions(data["favoriters_timeline"]["timeline"])
-		elif path.endswith("/Retweeters"):
-			self.add_with_instructions(data["retweeters_timeline"]["timeline"])
-		elif path.endswith("/FetchDraftTweets"):
-			#assert data == {"viewer":{"draft_list":{"response_data":[]}}}
-			pass
-		elif path.endswith("/FetchScheduledTweets"):
-			assert data == {"viewer":{"scheduled_tweet_list":[]}}
-		elif path.endswith("/AuthenticatedUserTFLists"): # circles
-			for circle in data["authenticated_user_trusted_friends_lists"]:
-				print("found circle named", circle["name"], "with", circle["member_count"], "people")
-		elif path.endswith("/CheckTweetForNudge"):
-			assert data == {"create_nudge":{}}
-		elif path.endswith("/CreateTweet"):
-			if "create_tweet" in data:
-				self.add_tweet(data["create_tweet"]["tweet_results"]["result"])
-		elif path.endswith("/UsersByRestIds"):
-			for user in data["users"]:
-				self.add_user(user)
-		elif path.endswith("/SearchTimeline"):
-			search_timeline = data["search_by_raw_query"]["search_timeline"]
-			if "timeline" in search_timeline:
-				self.add_with_instructions(search_timeline["timeline"])
-		elif path.endswith("/FavoriteTweet"):
-			pass
-		elif path.endswith("/UnfavoriteTweet"):
-			pass
-		elif path.endswith("/AudioSpaceById"):
-			pass
-		elif path.endswith("/CreateRetweet"):
-			pass # todo
-		elif path.endswith("/FollowersYouKnow"):
-			pass # todo
-		elif path.endswith("/BlueVerifiedFollowers"):
-			pass # todo
-		elif path.endswith("/CreateBookmark"):
-			pass # todo
-		elif path.endswith("/articleNudgeDomains"):
-			pass # todo
-		elif path.endswith("/useFetchProfileBlocks_profileExistsQuery"):
-			pass # todo
-		elif path.endswith("/PinnedTimelines"):
-			pass # todo
-		elif path.endswith("/ExploreSidebar"):
-			pass # todo
-		elif path.endswith("/ExplorePage"):
-			pass # todo
-		elif path.endswith("/UserPreferences"):
-			pass # todo
-		elif path.endswith("/useTypingNotifierMutation"):
-			pass # todo
-		elif path.endswith("/AccountSwitcherDelegateQuery"):
-			pass # todo
-		elif path.endswith("/DelegatedAccountListQuery"):
-			pass # todo
-		elif path.endswith("/SensitiveMediaSettingsQuery"):
-			pass # todo
-		elif path.endswith("/fetchDownloadSettingAllowedQuery"):
-			pass # todo
-		elif path.endswith("/ListsManagementPageTimeline"):
-			pass # todo
-		elif path.endswith("/ListLatestTweetsTimeline"):
-			pass # todo
-		elif path.endswith("/BroadcastQuery"):
-			pass # todo
-		elif path.endswith("/PutClientEducationFlag"):
-			pass # todo
-		elif path.endswith("/ConnectTabTimeline"):
-			pass # todo
-		elif path.endswith("/TweetResultByRestId"):
-			pass # todo
-		elif path.endswith("/TweetResultsByRestIds"):
-			for tweet_result in data["tweetResult"]:
-				if "result" in tweet_result:
-					self.add_tweet(tweet_result["result"])
-		elif path.endswith("/ModeratedTimeline"):
-			pass # todo
-		elif path.endswith("/PremiumSignUpQuery"):
-			pass # todo
-		elif path.endswith("/useSubscriptionProductDetailsQuery"):
-			pass # todo
-		elif path.endswith("/ListProductSubscriptions"):
-			pass # todo
-		elif path.endswith("/CommunitiesCreateButtonQuery"):
-			pass # todo
-		elif path.endswith("/CarouselQuery"):
-			pass # todo
-		elif path.endswith("/CommunitiesMainPageTimeline"):
-			pass # todo
-		elif path.endswith("/RemoveFollower"):
-			pass # todo
-		elif path.endswith("/ListOwnerships"):
-			pass # todo
-		elif path.endswith("/ListAddMember"):
-			pass # todo
-		elif path.endswith("/DeleteTweet"):
-			pass # todo
-		elif path.endswith("/ConversationControlChange"):
-			pass # todo
-		elif path.endswith("/DeleteRetweet"):
-			pass # todo
-		elif path.endswith("/PinTweet"):
-			pass # todo
-		elif path.endswith("/UnpinTweet"):
-			pass # todo
-		elif path.endswith("/useDMReactionMutationAddMutation"):
-			pass # todo
-		elif path.endswith("/DeleteBookmark"):
-			pass # todo
-		elif path.endswith("/CommunitiesFetchOneQuery"):
-			pass # todo
-		elif path.endswith("/BlueVerifiedProfileEditCalloutQuery"):
-			pass # todo
-		elif path.endswith("/ReportDetailQuery"):
-			pass # todo
-		elif path.endswith("/BirdwatchFetchAuthenticatedUserProfile"):
-			pass # todo
-		elif path.endswith("/BirdwatchFetchOneNote"):
-			pass # todo
-		elif path.endswith("/BirdwatchFetchAliasSelfSelectStatus"):
-			pass # todo
-		elif path.endswith("/BirdwatchFetchNotes"):
-			pass # todo
-		elif path.endswith("/usePricesQuery"):
-			pass # todo
-		elif path.endswith("/useVerifiedOrgFeatureHelperQuery"):
-			pass # todo
-		elif path.endswith("/useProductSkuQuery"):
-			pass # todo
-		elif path.endswith("/TranslationFeedbackProvideFeedbackMutation"):
-			pass # todo
-		elif path.endswith("/UserHighlightsTweets"):
-			pass # todo
-		elif path.endswith("/UserAccountLabel"):
-			pass # todo
-		elif path.endswith("/GenericTimelineById"):
-			pass # todo
-		elif path.endswith("/BookmarkSearchTimeline"):
-			pass # todo
-		elif path.endswith("/useRelayDelegateDataPendingQuery"):
-			pass # todo
-		elif path.endswith("/TrendRelevantUsers"):
-			pass # todo
-		elif path.endswith("/AiTrendByRestId"):
-			pass # todo
-		elif path.endswith("/FollowHostButtonQuery"):
-			pass # todo
-		elif path.endswith("/useFetchAnalyticsQuery"):
-			pass # todo
-		elif path.endswith("/AuthenticatePeriscope"):
-			pass # todo
-		elif path.endswith("/QuickPromoteEligibility"):
-			pass # todo
-		elif path.endswith("/TweetActivityQuery"):
-			pass # todo
-		elif path.endswith("/PremiumContentQuery"):
-			pass # todo
-		elif path.endswith("/SubscriptionProductDetails"):
-			pass # todo
-		elif path.endswith("/useFetchProfileSections_profileQuery"):
-			pass # todo
-		elif path.endswith("/GrokHome"):
-			pass # todo
-		elif path.endswith("/Viewer"):
-			pass # todo
-		elif path.endswith("/ViewerUserQuery"):
-			pass # todo
-		elif path.endswith("/affiliatesQuery"):
-			pass # todo
-		elif path.endswith("/BenefitsBadgeCardQuery"):
-			pass # todo
-		elif path.endswith("/CreateGrokConversation"):
-			pass # todo
-		elif path.endswith("/useFetchProfileSections_canViewExpandedProfileQuery"):
-			pass # todo
-		elif path.endswith("/SupportedLanguages"):
-			pass # todo
-		elif path.endswith("/GetGrokCustomizationSettingQuery"):
-			pass # todo
-		elif path.endswith("/feedbackMutation"):
-			pass # todo
-		elif path.endswith("/personalityHooksAllPersonalitiesQuery"):
-			pass # todo
-		elif path.endswith("/TopicCarouselQuery"):
-			pass # todo
-		elif path.endswith("/CommunitiesRankedTimeline"):
-			pass # todo
-		elif path.endswith("/CommunitiesExploreTimeline"):
-			pass # todo
-		elif path.endswith("/isEligibleForVoButtonUpsellQuery"):
-			pass # todo
-		elif path.endswith("/GrokHistory"):
-			pass # todo
-		elif path.endswith("/GrokConversationItemsByRestId"):
-			pass # todo
-		elif path.endswith("/isEligibleForAnalyticsUpsellQuery"):
-			pass # todo
-		elif path.endswith("/SidebarUserRecommendations"):
-			pass # todo
-		elif path.endswith("/NotificationsTimeline"):
-			pass # todo
-		elif path.endswith("/DmAllSearchSlice"):
-			pass # todo
-		elif path.endswith("/useFetchProfileSections_profileSectionsCountQuery"):
-			pass # todo
-		elif path.endswith("/useStoryTopicQuery"):
-			pass # todo
-		elif path.endswith("/VOCardsQuery"):
-			pass # todo
-		elif path.endswith("/useTotalAdCampaignsForUserQuery"):
-			pass # todo
-		elif path.endswith("/useUpsellTrackingMutation"):
-			pass # todo
-		elif path.endswith("/CommunityQuery"):
-			pass # todo
+	@gql("UserByScreenName")
+	def gql_UserByScreenName(self, data, context):
+		if data == {}:
+			return
+		self.add_user(data["user"]["result"])
+
+	@gql("HomeLatestTimeline")
+	def gql_HomeLatestTimeline(self, data, context):
+		if "home" in data:
+			if "home_timeline_urt" in data["home"]:
+				self.add_with_instructions(data["home"]["home_timeline_urt"])
+
+	@gql("HomeTimeline")
+	def gql_HomeTimeline(self, data, context):
+		self.add_with_instructions(data["home"]["home_timeline_urt"])
+
+	@gql("TweetDetail")
+	def gql_TweetDetail(self, data, context):
+		if data == {}:
+			return
+		self.add_with_instructions(data["threaded_conversation_with_injections_v2"])
+
+	@gql("UserTweets")
+	def gql_UserTweets(self, data, context):
+		tweet_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
+		if "errors" in self.toplevel and "timeline" not in tweet_timeline:
+			return
+		self.add_with_instructions(tweet_timeline["timeline"])
+
+	@gql("UserTweetsAndReplies")
+	def gql_UserTweetsAndReplies(self, data, context):
+		tweet_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
+		self.add_with_instructions(tweet_timeline["timeline"])
+
+	@gql("UserMedia")
+	def gql_UserMedia(self, data, context):
+		media_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
+		if media_timeline == {}:
+			return
+		self.add_with_instructions(media_timeline["timeline"])
+
+	@gql("Likes")
+	def gql_Likes(self, data, context):
+		gql_vars = self.get_gql_vars(context) or {}
+		whose_likes = int(gql_vars["userId"])
+		likes_timeline = self.add_user(data["user"]["result"], give_timeline_v2=True)
+		layout, cursors = self.add_with_instructions(likes_timeline["timeline"])
+
+		likes = []
+		for entry in layout:
+			if entry is None:
+				continue # non-tweet timeline item
+			sort_index, name, twid = entry
+			if twid is None:
+				continue # tweet deleted or on locked account
+			assert isinstance(twid, int)
+			likes.append((sort_index, twid))
+		cursors = [(cname, cdata["value"]) for cname, cdata in cursors]
+
+		if not likes:
+			return
+
+		if len(likes) > 1 and likes[0][0] != likes[1][0]+1:
+			snapshot = seqalign.Events(likes)
 		else:
-			assert False, path
+			snapshot = seqalign.Items([twid for sort_index, twid in likes])
+		snapshot.time = self.time
+		snapshot.continue_from = gql_vars.get("cursor", None)
+		for cname, value in cursors:
+			if cname.startswith("cursor-bottom-"):
+				snapshot.cursor_bottom = value
+				break
+		del cname, value
+
+		self.add_likes_snapshot(whose_likes, snapshot)
+
+	@gql("Bookmarks")
+	def gql_Bookmarks(self, data, context):
+		layout, cursors = self.add_with_instructions(data["bookmark_timeline_v2"]["timeline"])
+		user_bookmarks = self.bookmarks_map.setdefault(self.uid, {})
+		for entry in layout:
+			if entry is None:
+				continue # non-tweet timeline item
+			sort_index, name, twid = entry
+			if twid is None:
+				continue # tweet deleted or on locked account
+			assert isinstance(twid, int)
+			user_bookmarks[twid] = max(sort_index, user_bookmarks.get(twid, sort_index))
+
+	@gql("Following")
+	def gql_Following(self, data, context):
+		gql_vars = self.get_gql_vars(context) or {}
+		whose_followings = int(gql_vars["userId"])
+		followings_timeline = self.add_user(data["user"]["result"], give_timeline_v1=True)
+		layout, cursors = self.add_with_instructions(followings_timeline["timeline"])
+		for entry in layout:
+			if entry is None:
+				continue
+			sort_index, name, following_uid = entry
+			self.add_follow(whose_followings, following_uid)
+
+	@gql("Followers")
+	def gql_Followers(self, data, context):
+		gql_vars = self.get_gql_vars(context) or {}
+		whose_followers = int(gql_vars["userId"])
+		followers_timeline = self.add_user(data["user"]["result"], give_timeline_v1=True)
+		layout, cursors = self.add_with_instructions(followers_timeline["timeline"])
+		for entry in layout:
+			if entry is None:
+				continue
+			sort_index, name, follower_uid = entry
+			self.add_follow(follower_uid, whose_followers)
+
+	@gql("UsersVerifiedAvatars")
+	def gql_UsersVerifiedAvatars(self, data, context):
+		for result in data["usersResults"]:
+			self.add_user(result["result"])
+
+	@gql("getAltTextPromptPreference")
+	def gql_getAltTextPromptPreference(self, data, context):
+		assert data == {}
+
+	@gql("Favoriters")
+	def gql_Favoriters(self, data, context):
+		self.add_with_instructions(data["favoriters_timeline"]["timeline"])
+
+	@gql("Retweeters")
+	def gql_Retweeters(self, data, context):
+		self.add_with_instructions(data["retweeters_timeline"]["timeline"])
+
+	@gql("FetchScheduledTweets")
+	def gql_FetchScheduledTweets(self, data, context):
+		assert data == {"viewer":{"scheduled_tweet_list":[]}}
+
+	@gql("AuthenticatedUserTFLists") # circles
+	def gql_AuthenticatedUserTFLists(self, data, context):
+		for circle in data["authenticated_user_trusted_friends_lists"]:
+			print("found circle named", circle["name"], "with", circle["member_count"], "people")
+
+	@gql("CheckTweetForNudge")
+	def gql_CheckTweetForNudge(self, data, context):
+		assert data == {"create_nudge":{}}
+
+	@gql("CreateTweet")
+	def gql_CreateTweet(self, data, context):
+		if "create_tweet" in data:
+			self.add_tweet(data["create_tweet"]["tweet_results"]["result"])
+
+	@gql("UsersByRestIds")
+	def gql_UsersByRestIds(self, data, context):
+		for user in data["users"]:
+			self.add_user(user)
+
+	@gql("SearchTimeline")
+	def gql_SearchTimeline(self, data, context):
+		search_timeline = data["search_by_raw_query"]["search_timeline"]
+		if "timeline" in search_timeline:
+			self.add_with_instructions(search_timeline["timeline"])
+
+	@gql("TweetResultsByRestIds")
+	def gql_TweetResultsByRestIds(self, data, context):
+		for tweet_result in data["tweetResult"]:
+			if "result" in tweet_result:
+				self.add_tweet(tweet_result["result"])
 
 	def load_notifications(self, data, context):
 		self.apply_context(context)
@@ -1812,7 +2325,7 @@ class DB:
 				targets = [int(entry["tweet"]["id"]) for entry in t["targetObjects"]] # confirm empty else
 				for nuid in users:
 					for twid in targets:
-						self.likes_unsorted.setdefault(nuid, set()).add(twid)
+						self.add_unsorted_like(nuid, twid)
 
 	def load_api(self, fname, item, context):
 		url = context["url"]
@@ -1846,30 +2359,34 @@ class DB:
 			self.media.add_http_snapshot(url, item)
 			return
 
-		item_file = item.open()
-		try:
-			data = json.load(item_file, **json_load_args)
-		except:
-			print("not json", fname, path)
-			return
+		is_gql = url.startswith("https://twitter.com/i/api/graphql/") or url.startswith("https://x.com/i/api/graphql/")
+		with self.ingest.operation(path.rsplit("/", 1)[-1] if is_gql else path):
+			item_file = item.open()
+			try:
+				data = self.parse_json(item_file)
+			except:
+				print("not json", fname, path)
+				return
 
-		if url.startswith("https://twitter.com/i/api/graphql/") or url.startswith("https://x.com/i/api/graphql/"):
-			print("adding  ", fname, path)
-			self.load_gql(path, data, context)
-		elif path == "/i/api/2/notifications/all.json":
-			self.load_notifications(data, context)
-		else:
-			print("skipping", fname, path)
+			if is_gql:
+				print("adding  ", fname, path)
+				self.load_gql(path, data, context)
+			elif path == "/i/api/2/notifications/all.json":
+				self.load_notifications(data, context)
+			else:
+				print("skipping", fname, path)
 
 	def load_har(self, fname):
 		lhar = self.har.load(fname)
 		any_missing = False
-		for entry in lhar["log"]["entries"]:
+		# har entries are identified by position, for RemuxCache keys
+		origin = "har:{}:{}:".format(os.path.abspath(fname), os.stat(fname).st_mtime_ns)
+		for i, entry in enumerate(lhar["log"]["entries"]):
 			url = entry["request"]["url"]
 			response = entry["response"]["content"]
 			if response:
 				time = fromisoformat(entry["startedDateTime"])
-				item = self.har.get_lhar_entry(entry)
+				item = self.har.get_lhar_entry(entry, origin + str(i))
 				if not item:
 					print("missing ", url)
 					if "comment" in response:
@@ -1922,35 +2439,98 @@ class DB:
 
 		return (f, end)
 
-	def new_thread_view(self, twid):
-		seq = []
-
-		up = twid
-		while up:
-			tw = self.tweets.get(up, None)
-			seq.insert(0, (None, None, up))
-			up = tw and tw.get("in_reply_to_status_id_str", None)
-			up = up and int(up)
-		del up
-
-		dn = twid
-		while dn:
-			ndn = None
-			for r in self.replies.get(dn, []):
-				tw = self.tweets.get(r, None)
-				seq.append((None, None, r))
-				if tw:
-					ndn = r
-			dn = ndn
-		del dn
+	def reply_parent(self, twid):
+		tw = self.tweets.get(twid, None)
+		up = tw and tw.get("in_reply_to_status_id_str", None)
+		return up and int(up)
+
+	def new_thread_view(self, twid, depth=3, breadth=10, limit=300, cursor=None):
+		"""returns (ancestors, replies, next_cursor) where replies are (depth, twid)
+		in reading order. all direct replies to twid can be paged through, below
+		that only the first `breadth` replies per tweet down to `depth` levels are
+		included. the cursor is the last twid of the previous page"""
+
+		ancestors = []
+		if cursor is None:
+			seen = {twid}
+			up = self.reply_parent(twid)
+			while up and up not in seen and len(ancestors) < limit:
+				seen.add(up)
+				ancestors.append(up)
+				up = self.reply_parent(up)
+			ancestors.reverse()
+
+		def children(parent, level):
+			r = self.replies.get(parent, [])
+			return r if level == 0 else r[:breadth]
+
+		stack = [] # [children, next index, their depth]
+		if cursor is None:
+			stack.append([children(twid, 0), 0, 1])
+		else:
+			path = [cursor]
+			while path[-1] != twid:
+				up = self.reply_parent(path[-1])
+				if not up or len(path) > depth:
+					raise ValueError("cursor is not in this thread")
+				path.append(up)
+			path.reverse()
+			for level, (parent, child) in enumerate(zip(path, path[1:])):
+				r = children(parent, level)
+				stack.append([r, bisect.bisect_left(r, child) + 1, level + 1])
+			if len(path) - 1 < depth:
+				stack.append([children(cursor, len(path) - 1), 0, len(path)])
+
+		replies = []
+		while stack and len(replies) < limit:
+			frame = stack[-1]
+			r, i, level = frame
+			if i >= len(r):
+				stack.pop()
+				continue
+			frame[1] += 1
+			replies.append((level, r[i]))
+			if level < depth:
+				stack.append([children(r[i], level), 0, level + 1])
 
-		return seq
+		while stack and stack[-1][1] >= len(stack[-1][0]):
+			stack.pop()
+		next_cursor = replies[-1][1] if stack and replies else None
+		return ancestors, replies, next_cursor
 
 
 header_re = re.compile(rb"(.*): (.*)\r\n")
 
 # gather inputs
 
+# the options of db.py and server.py, anything else is a typo
+known_options = {
+	"workers", "slow-ms", # server.py
+	"sqlite", "sqlite-cache", "intern", "cold-tweets",
+	"remux-cache-mb", "remux-workers", "preremux", "no-load", "data-dir"
+}
+
+def parse_options(argv):
+	# --name or --name=value are options, everything else is a data source
+	options = {}
+	sources = []
+	for arg in argv:
+		if arg.startswith("--"):
+			name, eq, value = arg[2:].partition("=")
+			if name not in known_options:
+				sys.exit("unknown option --{}, expected one of: {}".format(name, ", ".join(sorted(known_options))))
+			options[name] = value if eq else True
+		else:
+			sources.append(arg)
+	return options, sources
+
+def option_flag(options, name):
+	"--name and --name=1 are on, --name=0 (or false, no, off) and no --name are off"
+	value = options.get(name, False)
+	if value is True or value is False:
+		return value
+	return value.lower() not in ("0", "false", "no", "off", "")
+
 def gather_paths(argv):
 	paths = []
 
@@ -2001,44 +2581,88 @@ def gather_paths(argv):
 
 # load inputs
 
-db = DB()
+options, sources = parse_options(sys.argv[1:])
+
+storage = None
+if "sqlite" in options:
+	if options["sqlite"] is True or not options["sqlite"]:
+		sys.exit("--sqlite needs a path, like --sqlite=corpus.sqlite3")
+	if "cold-tweets" in options:
+		sys.exit("--cold-tweets only works without --sqlite, which keeps only --sqlite-cache tweets in memory anyway")
+	storage = SqliteStore(options["sqlite"], cache=int(options.get("sqlite-cache", 100000)))
+
+freezer = None
+if "cold-tweets" in options:
+	# keep this many tweets as they are, compress the entities and cards of the others
+	freezer = Freezer(tweet_is_cold, hot=int(options["cold-tweets"]), summarize=tweet_cold_summary)
+
+db = DB(storage, data_dir=options.get("data-dir", "."), freezer=freezer) # data_dir for harstore/ and remuxcache/
+
+if "intern" in options:
+	if options["intern"] not in intern_policies:
+		sys.exit("--intern needs one of: {}".format(", ".join(intern_policies)))
+	json_load_args.clear()
+	json_load_args.update(intern_policies[options["intern"]])
 
 if os.path.exists("ignore.txt"):
 	with open("ignore.txt") as f:
 		ignore_urls = [line.strip() for line in f.readlines()]
 	db.ignore_urls = set(filter(None, ignore_urls))
 
+if "remux-cache-mb" in options:
+	db.media.remux_cache.budget = int(options["remux-cache-mb"]) * 1024**2
+if "remux-workers" in options:
+	db.media.remux_queue.workers = int(options["remux-workers"])
+	db.media.remux_queue.reset()
+
 warc_open = {}
 modules = {}
 
+def table_sizes():
+	return {
+		"tweets": len(db.tweets),
+		"profiles": len(db.profiles),
+		"warc_responses": len(db.warc_responses),
+		"media.media_by_url": len(db.media.media_by_url),
+		"intern_dict": len(dicts)
+	}
+
 def load_single(path):
-	print(path)
-	if path.endswith(".har"):
-		db.har.add(path, skip_if_exists=True)
-		db.load_har(path)
-	elif path.endswith(".warc"):
-		db.load_warc(path, warc_open.pop(path+".open", None))
-	elif path.endswith(".warc.open"):
-		warc_open[path] = db.load_warc(path, warc_open.get(path, None))
-	elif path.endswith(".zip"):
-		db.load(zipfile.ZipFile(path))
-	elif path.endswith(".py"):
-		module = modules.get(path, None)
-		if module:
-			spec = module.__spec__
+	with db.ingest.source(path):
+		print(path)
+		before = table_sizes()
+		if path.endswith(".har"):
+			db.har.add(path, skip_if_exists=True)
+			db.load_har(path)
+		elif path.endswith(".warc"):
+			db.load_warc(path, warc_open.pop(path+".open", None))
+		elif path.endswith(".warc.open"):
+			warc_open[path] = db.load_warc(path, warc_open.get(path, None))
+		elif path.endswith(".zip"):
+			db.load(zipfile.ZipFile(path))
+		elif path.endswith(".py"):
+			module = modules.get(path, None)
+			if module:
+				spec = module.__spec__
+			else:
+				spec = importlib.util.spec_from_file_location("__data_source__", path)
+				module = importlib.util.module_from_spec(spec)
+				module.db = db
+				modules[path] = module
+			spec.loader.exec_module(module)
 		else:
-			spec = importlib.util.spec_from_file_location("__data_source__", path)
-			module = importlib.util.module_from_spec(spec)
-			module.db = db
-			modules[path] = module
-		spec.loader.exec_module(module)
-	else:
-		db.load(path)
+			db.load(path)
+
+		# what each source added, for /api/debug/memory
+		added = db.added_by_source.setdefault(path, {})
+		for name, size in table_sizes().items():
+			added[name] = added.get(name, 0) + size - before[name]
 
 paths = []
 def db_reload():
 	global paths
-	new_paths = gather_paths(sys.argv[1:])
+	db.ingest.begin_reload()
+	new_paths = gather_paths(sources)
 	for path in new_paths:
 		if path not in paths or path.endswith(".warc.open") or path.endswith(".py"):
 			load_single(path)
@@ -2048,13 +2672,22 @@ def db_reload():
 
 	db.sort_profiles()
 
+	if option_flag(options, "preremux"):
+		db.media.preremux()
+
 	# print how many tweets by who are in the archive
 	z = [(len(v), db.profiles[k]["screen_name"] if k in db.profiles else str(k), k) for k, v in db.by_user.items()]
 	z.sort()
 	for count, name, uid in z:
 		print("{:4d} {}".format(count, name))
 
+	if db.storage:
+		db.storage.flush()
+
+	db.ingest.end_reload()
+
 db.reload = db_reload
 
-db.reload()
+if not option_flag(options, "no-load"): # for tools that load the sources themselves
+	db.reload()
 
@@ -1,4 +1,4 @@
-import os, os.path, json, io, hashlib, base64, gzip, re
+import os, os.path, json, io, hashlib, base64, gzip, re, bisect
 try: import brotli
 except: print("warning: brotli-compressed data in warcs can't be decoded without brotli module")
 
@@ -10,6 +10,16 @@ class OnDisk:
 	def open(self):
 		return open(self.path, self.mode)
 
+	def open_bytes(self):
+		return open(self.path, "rb")
+
+	def content_length(self):
+		return os.path.getsize(self.path)
+
+	def identity(self):
+		st = os.stat(self.path)
+		return "disk:{}:{}:{}".format(os.path.abspath(self.path), st.st_size, st.st_mtime_ns)
+
 class InZip:
 	def __init__(self, zipf, path):
 		self.zipf = zipf
@@ -18,9 +28,20 @@ class InZip:
 	def open(self):
 		return self.zipf.open(self.path)
 
+	def open_bytes(self):
+		return self.zipf.open(self.path) # seekable, but seeking in deflated members rereads them
+
+	def content_length(self):
+		return self.zipf.getinfo(self.path).file_size
+
+	def identity(self):
+		info = self.zipf.getinfo(self.path)
+		return "zip:{}:{}:{}".format(self.zipf.filename, self.path, info.CRC)
+
 class InMemory:
-	def __init__(self, data):
+	def __init__(self, data, origin=None):
 		self.data = data
+		self.origin = origin # where the data came from, if that identifies it
 
 	def open(self):
 		data = self.data
@@ -29,6 +50,59 @@ class InMemory:
 		elif isinstance(data, bytes):
 			return io.BytesIO(data)
 
+	def as_bytes(self):
+		data = self.data
+		if isinstance(data, str):
+			data = data.encode("utf-8")
+		return data
+
+	def open_bytes(self):
+		return io.BytesIO(self.as_bytes())
+
+	def content_length(self):
+		return len(self.as_bytes())
+
+	def identity(self):
+		if self.origin:
+			return "{}:{}".format(self.origin, len(self.data))
+		return "mem:" + hashlib.sha1(self.as_bytes()).hexdigest()
+
+def read_at(f, offset, size):
+	# pread leaves the shared file position alone, which matters once
+	# several threads or forked workers read from the same warc
+	if hasattr(os, "pread"):
+		return os.pread(f.fileno(), size, offset)
+	f.seek(offset)
+	return f.read(size)
+
+class FileSlice(io.RawIOBase):
+	def __init__(self, f, offset, size):
+		self.f = f
+		self.offset = offset
+		self.length = size
+		self.pos = 0
+
+	def readable(self): return True
+	def seekable(self): return True
+	def tell(self): return self.pos
+
+	def seek(self, pos, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			pos += self.pos
+		elif whence == io.SEEK_END:
+			pos += self.length
+		self.pos = max(0, pos)
+		return self.pos
+
+	def readinto(self, b):
+		n = min(len(b), self.length - self.pos)
+		if n <= 0:
+			return 0
+		data = read_at(self.f, self.offset + self.pos, n)
+		b[:len(data)] = data
+		self.pos += len(data)
+		return len(data)
+
 class InWarc:
 	def __init__(self, f, offset, size, mode="rb", encoding=None, chunked=False):
 		self.f = f
@@ -39,26 +113,111 @@ class InWarc:
 		self.chunked = chunked
 		assert mode in ("r", "rb")
 
-	def open(self):
+	def read(self):
 		if self.chunked:
 			raise Exception("chunking not supported")
-		self.f.seek(self.offset)
-		data = self.f.read(self.size)
+		data = read_at(self.f, self.offset, self.size)
 		if self.encoding == "gzip":
 			data = gzip.decompress(data)
 		elif self.encoding == "br":
 			data = brotli.decompress(data)
+		return data
+
+	def open(self):
+		data = self.read()
 		if self.mode == "r":
 			return io.BytesIO(data)
 		else:
 			return io.StringIO(data.decode("utf-8"))
 
+	def open_bytes(self):
+		if self.encoding or self.chunked:
+			return io.BytesIO(self.read())
+		return io.BufferedReader(FileSlice(self.f, self.offset, self.size))
+
+	def content_length(self):
+		if self.encoding or self.chunked:
+			return None # only known after decoding
+		return self.size
+
+	def identity(self):
+		return "warc:{}:{}:{}".format(self.f.name, self.offset, self.size)
+
+class ConcatReader(io.RawIOBase):
+	def __init__(self, parts, lengths):
+		self.parts = parts
+		self.starts = []
+		start = 0
+		for length in lengths:
+			self.starts.append(start)
+			start += length
+		self.length = start
+		self.pos = 0
+		self.current = None # (index, file)
+
+	def readable(self): return True
+	def seekable(self): return True
+	def tell(self): return self.pos
+
+	def seek(self, pos, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			pos += self.pos
+		elif whence == io.SEEK_END:
+			pos += self.length
+		self.pos = max(0, pos)
+		return self.pos
+
+	def readinto(self, b):
+		if self.pos >= self.length:
+			return 0
+		i = bisect.bisect_right(self.starts, self.pos) - 1
+		if self.current is None or self.current[0] != i:
+			if self.current:
+				self.current[1].close()
+			self.current = (i, self.parts[i].open_bytes())
+		f = self.current[1]
+		f.seek(self.pos - self.starts[i])
+		end = self.starts[i+1] if i+1 < len(self.starts) else self.length
+		data = f.read(min(len(b), end - self.pos))
+		if not data:
+			return 0
+		b[:len(data)] = data
+		self.pos += len(data)
+		return len(data)
+
+	def close(self):
+		if self.current:
+			self.current[1].close()
+			self.current = None
+		io.RawIOBase.close(self)
+
+class InConcat:
+	def __init__(self, parts):
+		self.parts = parts
+
+	def open(self):
+		return self.open_bytes()
+
+	def open_bytes(self):
+		lengths = [part.content_length() for part in self.parts]
+		if None in lengths:
+			return io.BytesIO(b"".join(part.open_bytes().read() for part in self.parts))
+		return io.BufferedReader(ConcatReader(self.parts, lengths))
+
+	def content_length(self):
+		lengths = [part.content_length() for part in self.parts]
+		if None in lengths:
+			return None
+		return sum(lengths)
+
+	def identity(self):
+		return "concat:" + ",".join(part.identity() for part in self.parts)
+
 class HarStore:
-	def __init__(self, path):
+	def __init__(self, path, readonly=False):
 		self.path = path = path.rstrip("/")
 		assert path
-		os.makedirs(path + "/blob", exist_ok=True)
-		os.makedirs(path + "/lhar", exist_ok=True)
+		self.readonly = readonly # read what's there, but don't add to it
 
 	def load(self, har_path):		
 		lhar_path = self.path + "/lhar/" + os.path.basename(har_path)
@@ -87,14 +246,14 @@ class HarStore:
 		if "hashtxt" in content or "hashbin" in content or "text" in content:
 			return True
 
-	def get_lhar_entry(self, entry):
+	def get_lhar_entry(self, entry, origin=None):
 		content = entry.get("response", {}).get("content", None)
 		if "hashtxt" in content:
 			e = OnDisk(self.path + "/blob/" + content["hashtxt"], "r")
 		elif "hashbin" in content:
 			e = OnDisk(self.path + "/blob/" + content["hashbin"], "rb")
 		elif "text" in content:
-			e = InMemory(self.get_har_entry_data(entry))
+			e = InMemory(self.get_har_entry_data(entry), origin)
 		else:
 			return None
 		e.mime = content.get("mimeType", None)
@@ -114,9 +273,11 @@ class HarStore:
 
 	def add(self, har_path, skip_if_exists=False):
 		lhar_path = self.path + "/lhar/" + os.path.basename(har_path)
-		if skip_if_exists and os.path.exists(lhar_path):
+		if self.readonly or skip_if_exists and os.path.exists(lhar_path):
 			return
 
+		os.makedirs(self.path + "/blob", exist_ok=True)
+		os.makedirs(self.path + "/lhar", exist_ok=True)
 		with open(har_path) as f:
 			har = json.load(f)
 		entries = har.get("log", {}).get("entries", [])
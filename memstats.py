@@ -0,0 +1,96 @@
+# Approximate memory use of the DB, for /api/debug/memory. Walking every
+# object of a big corpus would take minutes and touch (and so copy, in forked
+# workers) the whole heap, so the size of a container is estimated from a
+# sample of its entries: deep size of the sampled keys and values, times the
+# number of entries. Dicts and sets are sampled at both ends, not all over, as
+# getting to the middle would mean walking half of them. Objects shared between entries (interned strings, the
+# intern_dict sizes) are counted once per entry, so the numbers are upper
+# bounds.
+
+import itertools, sys
+from collections.abc import Mapping
+from storage import SqliteTable
+
+# only objects of these modules are looked into, not files, sockets, modules
+# or the sqlite store (its tables are reported as DB attributes)
+own_modules = {"db", "records", "har", "seqalign", "__main__"}
+
+def deep_size(obj, seen):
+	size = 0
+	stack = [obj]
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		t = type(obj)
+		if t is dict:
+			stack.extend(obj.keys())
+			stack.extend(obj.values())
+		elif t in (list, tuple, set, frozenset):
+			stack.extend(obj)
+		elif t.__module__ in own_modules and not isinstance(obj, type):
+			if hasattr(obj, "__dict__"):
+				stack.append(obj.__dict__)
+			for cls in t.__mro__:
+				for slot in cls.__dict__.get("__slots__", ()):
+					value = getattr(obj, slot, None)
+					if value is not None:
+						stack.append(value)
+	return size
+
+def sample_entries(container, n):
+	"""up to n entries of the container, each a list of objects. Sequences are
+	sampled evenly, other containers can only be walked from their ends, so to
+	not touch all of them the oldest and newest entries are taken."""
+	if isinstance(container, SqliteTable):
+		container = container.cache # only what's in memory
+	size = len(container)
+	n = max(1, min(n, size))
+	if isinstance(container, (list, tuple)):
+		return [[container[i * size // n]] for i in range(n if size else 0)]
+	items = container.items() if isinstance(container, Mapping) else container
+	if size <= n:
+		return [list(item) if isinstance(container, Mapping) else [item] for item in items]
+	head = list(itertools.islice(items, n // 2))
+	try:
+		tail = list(itertools.islice(reversed(items), n - len(head)))
+	except TypeError: # sets
+		head = list(itertools.islice(items, n))
+		tail = []
+	if isinstance(container, Mapping):
+		return [list(item) for item in head + tail]
+	return [[item] for item in head + tail]
+
+def estimate(container, n=100):
+	"returns (entries in memory, estimated bytes, entries sampled)"
+	sample = sample_entries(container, n)
+	count = len(container.cache) if isinstance(container, SqliteTable) else len(container)
+	if not sample:
+		return count, sys.getsizeof(container), 0
+	total = 0
+	for entry in sample:
+		seen = set()
+		total += sum(deep_size(obj, seen) for obj in entry)
+	return count, sys.getsizeof(container) + total * count // len(sample), len(sample)
+
+def is_container(value):
+	return isinstance(value, (Mapping, list, tuple, set, frozenset))
+
+def report(db, extra=(), n=100):
+	"estimates for the containers in db's attributes (one level into other objects) and in extra"
+	containers = []
+	for name, value in vars(db).items():
+		if is_container(value):
+			containers.append((name, value))
+		elif type(value).__module__ in own_modules:
+			containers.extend((name + "." + sub, v) for sub, v in vars(value).items() if is_container(v))
+	containers.extend(extra)
+	result = {}
+	for name, value in containers:
+		count, size, sampled = estimate(value, n)
+		result[name] = {"count": count, "bytes": size, "sampled": sampled}
+		if isinstance(value, SqliteTable):
+			result[name]["rows"] = len(value)
+	return dict(sorted(result.items(), key=lambda item: -item[1]["bytes"]))
@@ -0,0 +1,132 @@
+# Request metrics for /api/debug/metrics: latency histograms and response
+# sizes per route, and cProfile summaries of slow requests. Profiling every
+# request would slow all of them down, so a route is only profiled after one
+# of its requests took longer than slow_ms, until a profiled request of it is
+# fast again. Each forked worker keeps its own metrics.
+
+import collections, cProfile, io, os, pstats, time
+
+buckets_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class RouteStats:
+	def __init__(self):
+		self.count = 0
+		self.seconds = 0.0
+		self.max_seconds = 0.0
+		self.bytes = 0
+		self.max_bytes = 0
+		self.slow = 0
+		self.histogram = [0] * (len(buckets_ms) + 1) # the last one is for everything slower
+
+	def add(self, seconds, size, slow):
+		self.count += 1
+		self.seconds += seconds
+		self.max_seconds = max(self.max_seconds, seconds)
+		self.bytes += size
+		self.max_bytes = max(self.max_bytes, size)
+		self.slow += slow
+		ms = seconds * 1000
+		i = 0
+		while i < len(buckets_ms) and ms > buckets_ms[i]:
+			i += 1
+		self.histogram[i] += 1
+
+	def report(self):
+		return {
+			"count": self.count,
+			"ms_avg": 1000 * self.seconds / self.count,
+			"ms_max": 1000 * self.max_seconds,
+			"bytes_avg": self.bytes // self.count,
+			"bytes_max": self.max_bytes,
+			"slow": self.slow,
+			"histogram": self.histogram
+		}
+
+class Metered:
+	"the response body of a request, counting its bytes until it's closed"
+	def __init__(self, metrics, environ, body, t0, profiler):
+		self.metrics = metrics
+		self.environ = environ
+		self.body = body
+		self.t0 = t0
+		self.profiler = profiler
+		self.size = 0
+
+	def __iter__(self):
+		for chunk in self.body:
+			self.size += len(chunk)
+			yield chunk
+
+	def close(self):
+		try:
+			if hasattr(self.body, "close"):
+				self.body.close()
+		finally:
+			if self.profiler:
+				self.profiler.disable()
+			self.metrics.record(self.environ, time.perf_counter() - self.t0, self.size, self.profiler)
+
+class Metrics:
+	def __init__(self, app, slow_ms=500, keep=20):
+		self.app = app # the bottle app, to find the route of a request
+		self.slow_ms = slow_ms
+		self.routes = {} # "METHOD rule" -> RouteStats
+		self.suspects = set() # routes to profile
+		self.slow_requests = collections.deque(maxlen=keep)
+
+	def route_name(self, environ):
+		route = environ.get("bottle.route", None)
+		if route is None:
+			return "unrouted"
+		return route.method + " " + route.rule
+
+	def match(self, environ):
+		try:
+			route, args = self.app.router.match(environ)
+		except Exception: # 404 and 405 are HTTPErrors
+			return None
+		return route.method + " " + route.rule
+
+	def __call__(self, environ, start_response):
+		t0 = time.perf_counter()
+		profiler = None
+		if self.suspects and self.match(environ) in self.suspects:
+			profiler = cProfile.Profile()
+			profiler.enable()
+		body = self.app(environ, start_response)
+		return Metered(self, environ, body, t0, profiler)
+
+	def record(self, environ, seconds, size, profiler):
+		name = self.route_name(environ)
+		slow = seconds * 1000 >= self.slow_ms
+		self.routes.setdefault(name, RouteStats()).add(seconds, size, slow)
+		if not slow:
+			self.suspects.discard(name)
+		elif not profiler:
+			self.suspects.add(name)
+		else:
+			s = io.StringIO()
+			pstats.Stats(profiler, stream=s).strip_dirs().sort_stats("cumulative").print_stats(15)
+			self.slow_requests.append({
+				"time": time.time(),
+				"route": name,
+				"url": environ.get("PATH_INFO", "") + ("?" + environ["QUERY_STRING"] if environ.get("QUERY_STRING") else ""),
+				"ms": seconds * 1000,
+				"bytes": size,
+				"profile": s.getvalue()
+			})
+
+	def report(self, caches={}):
+		"caches are name -> something with hits and misses"
+		return {
+			"pid": os.getpid(),
+			"slow_ms": self.slow_ms,
+			"buckets_ms": buckets_ms,
+			"routes": {name: stats.report() for name, stats in sorted(self.routes.items(), key=lambda item: -item[1].seconds)},
+			"caches": {name: {
+				"hits": cache.hits,
+				"misses": cache.misses,
+				"ratio": cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else None
+			} for name, cache in caches.items()},
+			"slow_requests": list(self.slow_requests)
+		}
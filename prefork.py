@@ -0,0 +1,159 @@
+# Serve the bottle app from several forked worker processes. The parent loads
+# the database once and then only binds the socket, forks workers and handles
+# reloads, so the loaded dicts are shared copy-on-write between all workers.
+#
+# Refcount updates still write to every object a worker touches, but at least
+# gc.freeze() keeps the cyclic garbage collector from walking (and thereby
+# dirtying) the whole heap in each worker.
+
+import os, gc, signal, time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+from bottle import ServerAdapter
+
+class QuietHandler(WSGIRequestHandler):
+	def address_string(self): # no reverse DNS lookups
+		return self.client_address[0]
+
+class SharedSocketServer(WSGIServer):
+	# all workers select() on the same listening socket, only one of them
+	# wins the accept(), the others must not block in it
+	def server_activate(self):
+		WSGIServer.server_activate(self)
+		self.socket.setblocking(False)
+
+	def get_request(self):
+		request, client_address = self.socket.accept()
+		request.setblocking(True)
+		return request, client_address
+
+class PreforkServer(ServerAdapter):
+	def __init__(self, host="127.0.0.1", port=8080, workers=2, reload=None, **options):
+		ServerAdapter.__init__(self, host, port, **options)
+		self.workers = workers
+		self.reload = reload # called in the parent on SIGHUP
+		self.pids = set()
+		self.reload_requested = False
+
+	def run(self, app):
+		self.srv = make_server(self.host, self.port, app, SharedSocketServer, QuietHandler)
+
+		def request_reload(*args):
+			self.reload_requested = True
+		signal.signal(signal.SIGHUP, request_reload)
+
+		gc.freeze()
+		self.spawn(self.workers)
+		try:
+			while True:
+				time.sleep(0.5)
+				self.reap()
+				if self.reload_requested:
+					self.reload_requested = False
+					self.cycle()
+				elif len(self.pids) < self.workers:
+					print("restarting crashed workers")
+					self.spawn(self.workers - len(self.pids))
+		finally:
+			for pid in self.pids:
+				os.kill(pid, signal.SIGTERM)
+
+	def spawn(self, n):
+		for i in range(n):
+			pid = os.fork()
+			if pid == 0:
+				try:
+					self.serve()
+				finally:
+					os._exit(0)
+			self.pids.add(pid)
+
+	def serve(self):
+		stopping = False
+		def stop(*args):
+			nonlocal stopping
+			stopping = True
+		signal.signal(signal.SIGTERM, stop)
+		signal.signal(signal.SIGHUP, signal.SIG_DFL)
+		self.srv.timeout = 0.5
+		try:
+			while not stopping:
+				self.srv.handle_request()
+		except KeyboardInterrupt:
+			pass
+
+	def reap(self):
+		while self.pids:
+			pid, status = os.waitpid(-1, os.WNOHANG)
+			if pid == 0:
+				break
+			self.pids.discard(pid)
+
+	def cycle(self):
+		# reload once in the parent, then let fresh workers inherit the result
+		# while the old ones finish their current request and exit
+		old_pids = self.pids
+		self.pids = set()
+		gc.unfreeze()
+		try:
+			if self.reload:
+				self.reload()
+		finally:
+			gc.freeze()
+			self.spawn(self.workers)
+			for pid in old_pids:
+				os.kill(pid, signal.SIGTERM)
+			for pid in old_pids:
+				os.waitpid(pid, 0)
+
+def request_reload():
+	"ask the parent of this worker to reload and replace all workers"
+	os.kill(os.getppid(), signal.SIGHUP)
+
+# memory reporting
+
+def memory_usage(pid):
+	"returns sizes from /proc/<pid>/smaps_rollup in kB, or None where unavailable"
+	try:
+		with open("/proc/{}/smaps_rollup".format(pid)) as f:
+			lines = f.readlines()
+	except OSError:
+		return None
+	usage = {}
+	for line in lines[1:]:
+		name, value, *unit = line.split()
+		usage[name.rstrip(":")] = int(value)
+	return usage
+
+def sibling_pids():
+	ppid = os.getppid()
+	pids = []
+	for name in os.listdir("/proc"):
+		if not name.isdigit():
+			continue
+		try:
+			with open("/proc/{}/stat".format(name)) as f:
+				stat = f.read()
+		except OSError:
+			continue
+		# the process name in parentheses may contain spaces
+		if int(stat.rsplit(")", 1)[1].split()[1]) == ppid:
+			pids.append(int(name))
+	pids.sort()
+	return pids
+
+def worker_report():
+	parent = os.getppid()
+	report = {"parent": {"pid": parent, "memory": memory_usage(parent)}, "workers": []}
+	for pid in sibling_pids():
+		usage = memory_usage(pid)
+		overhead = None
+		if usage:
+			# pages this worker has copied (or allocated) for itself
+			overhead = usage.get("Private_Clean", 0) + usage.get("Private_Dirty", 0)
+		report["workers"].append({
+			"pid": pid,
+			"current": pid == os.getpid(),
+			"memory": usage,
+			"overhead_kb": overhead
+		})
+	return report
@@ -0,0 +1,521 @@
+# Compact storage for tweets and profiles. The fields that indexing and
+# rendering read all the time are kept in __slots__, ids and dates as ints
+# instead of strings, and everything else stays in a small dict of rarely read
+# keys that is only created when needed. Records behave enough like the dicts
+# they replace (get, [], in, setdefault, update, pop, items) that the loaders
+# don't need to know, and copy() rehydrates a plain dict for ClientAPI to patch
+# and serialize.
+#
+# A value that doesn't fit its field's encoding (an id that isn't a plain
+# decimal string, a date in another format, a None) is kept in the dict as is,
+# so records always give back exactly what was put in.
+
+import calendar, collections, pickle, time, zlib
+try: import zstandard
+except ImportError: zstandard = None
+
+MISSING = object()
+
+class Field:
+	def __init__(self, slot):
+		self.slot = slot
+
+	def get(self, record):
+		value = getattr(record, self.slot)
+		return MISSING if value is None else self.decode(value)
+
+	def set(self, record, value):
+		"returns False if the value has to go to record.extra instead"
+		encoded = self.encode(value)
+		setattr(record, self.slot, encoded)
+		return encoded is not None
+
+	def delete(self, record):
+		was_set = getattr(record, self.slot) is not None
+		setattr(record, self.slot, None)
+		return was_set
+
+	def encode(self, value): return value
+	def decode(self, value): return value
+
+class IdField(Field):
+	"decimal id strings, stored as ints"
+	def encode(self, value):
+		# isdigit() alone would let through things like "²" that int() rejects
+		if type(value) is str and value.isascii() and value.isdecimal() and (value[0] != "0" or value == "0"):
+			return int(value)
+	def decode(self, value):
+		return str(value)
+
+class AnyField(Field):
+	def encode(self, value):
+		return value # None can't be told apart from unset, it goes to extra
+
+empty_entities = {}
+
+class EntitiesField(Field):
+	"""entities with nothing in them are the same for all tweets, they're kept
+	as a shared tuple of their keys and each get makes a new dict of them"""
+	def encode(self, value):
+		if type(value) is dict and not any(value.values()) and all(type(v) is list for v in value.values()):
+			keys = tuple(value)
+			return empty_entities.setdefault(keys, keys)
+		return value
+	def decode(self, value):
+		if type(value) is tuple:
+			return {key: [] for key in value}
+		return value
+
+class IntField(Field):
+	def encode(self, value):
+		if type(value) is int:
+			return value
+
+class StrField(Field):
+	def encode(self, value):
+		if type(value) is str:
+			return value
+
+month_names = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+day_names = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+month_numbers = {name: i+1 for i, name in enumerate(month_names)}
+
+def format_date(ms):
+	tm = time.gmtime(ms // 1000)
+	return "{} {} {:02d} {:02d}:{:02d}:{:02d} +0000 {}".format(
+		day_names[tm.tm_wday], month_names[tm.tm_mon-1], tm.tm_mday,
+		tm.tm_hour, tm.tm_min, tm.tm_sec, tm.tm_year)
+
+class DateField(Field):
+	"dates like 'Wed Oct 10 20:19:24 +0000 2018', stored as ms since the epoch"
+	def encode(self, value):
+		if type(value) is not str or len(value) != 30:
+			return None
+		try:
+			wd, mon, day, hms, tz, year = value.split(" ")
+			h, m, s = hms.split(":")
+			ms = calendar.timegm((int(year), month_numbers[mon], int(day), int(h), int(m), int(s))) * 1000
+		except (ValueError, KeyError):
+			return None
+		if format_date(ms) != value:
+			return None
+		return ms
+	def decode(self, value):
+		return format_date(value)
+
+class FlagField(Field):
+	"booleans, two bits each (present, value) in a shared slot"
+	def __init__(self, slot, bit):
+		Field.__init__(self, slot)
+		self.present = 1 << (2*bit)
+		self.true = 1 << (2*bit+1)
+
+	def get(self, record):
+		flags = getattr(record, self.slot)
+		if flags is None or not flags & self.present:
+			return MISSING
+		return bool(flags & self.true)
+
+	def set(self, record, value):
+		flags = (getattr(record, self.slot) or 0) & ~(self.present | self.true)
+		if type(value) is bool:
+			flags |= self.present | (self.true if value else 0)
+		setattr(record, self.slot, flags or None)
+		return type(value) is bool
+
+	def delete(self, record):
+		flags = getattr(record, self.slot) or 0
+		setattr(record, self.slot, (flags & ~(self.present | self.true)) or None)
+		return bool(flags & self.present)
+
+class Record:
+	__slots__ = ("extra", "cold")
+	fields = {} # key -> Field
+
+	def __init__(self, d=()):
+		for slot in self.slot_names:
+			setattr(self, slot, None)
+		self.extra = None # dict of the other keys, if there are any
+		self.cold = None # (keys, compressed values, summary, freezer) of keys that were frozen, see Freezer
+		self.update(d)
+
+	def thaw(self):
+		self.cold[3].thaw(self)
+
+	def is_cold(self, key):
+		return self.cold is not None and key in self.cold[0]
+
+	def peek(self, key, default=None):
+		"like get, but leaves frozen keys frozen"
+		if self.cold is not None and key in self.cold[0]:
+			return self.cold[3].unpack(self.cold[1])[key]
+		return self.get(key, default)
+
+	def frozen_summary(self):
+		"what the freezer kept uncompressed of the frozen keys, or None"
+		return self.cold[2] if self.cold is not None else None
+
+	def __getitem__(self, key):
+		if self.cold is not None and key in self.cold[0]:
+			self.thaw()
+		field = self.fields.get(key, None)
+		if field is not None:
+			value = field.get(self)
+			if value is not MISSING:
+				return value
+		if self.extra is None:
+			raise KeyError(key)
+		return self.extra[key]
+
+	def get(self, key, default=None):
+		if self.cold is not None and key in self.cold[0]:
+			self.thaw()
+		field = self.fields.get(key, None)
+		if field is not None:
+			value = field.get(self)
+			if value is not MISSING:
+				return value
+		if self.extra is None:
+			return default
+		return self.extra.get(key, default)
+
+	def __contains__(self, key):
+		if self.cold is not None and key in self.cold[0]:
+			return True
+		field = self.fields.get(key, None)
+		if field is not None and field.get(self) is not MISSING:
+			return True
+		return self.extra is not None and key in self.extra
+
+	def __setitem__(self, key, value):
+		if self.cold is not None and key in self.cold[0]:
+			self.thaw()
+		field = self.fields.get(key, None)
+		if field is not None and field.set(self, value):
+			if self.extra is not None:
+				self.extra.pop(key, None)
+		elif self.extra is None:
+			self.extra = {key: value}
+		else:
+			self.extra[key] = value
+
+	def __delitem__(self, key):
+		if self.cold is not None and key in self.cold[0]:
+			self.thaw()
+		field = self.fields.get(key, None)
+		if field is not None and field.delete(self):
+			return
+		if self.extra is None:
+			raise KeyError(key)
+		del self.extra[key]
+		if not self.extra:
+			self.extra = None
+
+	def pop(self, key, *default):
+		value = self.get(key, MISSING)
+		if value is MISSING:
+			if default:
+				return default[0]
+			raise KeyError(key)
+		del self[key]
+		return value
+
+	def setdefault(self, key, default=None):
+		value = self.get(key, MISSING)
+		if value is MISSING:
+			self[key] = default
+			value = self[key]
+		return value
+
+	def update(self, other=(), **kwargs):
+		if hasattr(other, "items"):
+			other = other.items()
+		for key, value in other:
+			self[key] = value
+		for key, value in kwargs.items():
+			self[key] = value
+
+	def items(self):
+		if self.cold is not None:
+			self.thaw()
+		for key, field in self.fields.items():
+			value = field.get(self)
+			if value is not MISSING:
+				yield key, value
+		if self.extra is not None:
+			yield from self.extra.items()
+
+	def keys(self):
+		return [key for key, value in self.items()]
+
+	def values(self):
+		return [value for key, value in self.items()]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return sum(1 for item in self.items())
+
+	def __bool__(self):
+		# without this, truth tests would fall back to __len__, which decodes
+		# (and thaws) everything
+		return self.extra is not None or self.cold is not None or \
+			any(getattr(self, slot) is not None for slot in self.slot_names)
+
+	def copy(self):
+		return dict(self.items())
+
+	def __repr__(self):
+		return "{}({!r})".format(type(self).__name__, self.copy())
+
+	def __getstate__(self):
+		# just the slot values, for pickling tables of records
+		if self.cold is not None:
+			self.thaw() # the compression dictionary is only known to this process
+		return tuple(getattr(self, slot) for slot in self.slot_names) + (self.extra,)
+
+	def __setstate__(self, state):
+		for slot, value in zip(self.slot_names, state):
+			setattr(self, slot, value)
+		self.extra = state[-1]
+		self.cold = None
+
+def record_type(name, fields):
+	"a Record subclass with a slot per field (flags share one)"
+	slot_names = []
+	for field in fields.values():
+		if field.slot not in slot_names:
+			slot_names.append(field.slot)
+	return type(name, (Record,), {
+		"__slots__": tuple(slot_names),
+		"slot_names": tuple(slot_names),
+		"fields": fields
+	})
+
+Tweet = record_type("Tweet", {
+	"id_str": IdField("id"),
+	"user_id_str": IdField("user_id"),
+	"original_id": IntField("original_id"),
+	"in_reply_to_status_id_str": IdField("in_reply_to"),
+	"in_reply_to_user_id_str": IdField("in_reply_to_user"),
+	"in_reply_to_screen_name": StrField("in_reply_to_screen_name"),
+	"quoted_status_id_str": IdField("quoted"),
+	"conversation_id_str": IdField("conversation"),
+	"created_at": DateField("created_at"),
+	"full_text": StrField("full_text"),
+	"lang": StrField("lang"),
+	"display_text_range": AnyField("display_text_range"),
+	"entities": EntitiesField("entities"),
+	"extended_entities": AnyField("extended_entities"),
+	"favorite_count": IntField("favorite_count"),
+	"retweet_count": IntField("retweet_count"),
+	"reply_count": IntField("reply_count"),
+	"quote_count": IntField("quote_count"),
+	"bookmark_count": IntField("bookmark_count"),
+	"is_quote_status": FlagField("flags", 0),
+	"possibly_sensitive": FlagField("flags", 1),
+	"truncated": FlagField("flags", 2),
+	"protected": FlagField("flags", 3)
+})
+
+Profile = record_type("Profile", {
+	"screen_name": StrField("screen_name"),
+	"name": StrField("name"),
+	"description": StrField("description"),
+	"location": StrField("location"),
+	"profile_image_url_https": StrField("profile_image_url_https"),
+	"profile_banner_url": StrField("profile_banner_url"),
+	"created_at": DateField("created_at"),
+	"followers_count": IntField("followers_count"),
+	"friends_count": IntField("friends_count"),
+	"statuses_count": IntField("statuses_count"),
+	"favourites_count": IntField("favourites_count"),
+	"media_count": IntField("media_count"),
+	"entities": AnyField("entities"),
+	"pinned_tweet_ids_str": AnyField("pinned_tweet_ids_str"),
+	"protected": FlagField("flags", 0),
+	"verified": FlagField("flags", 1),
+	"following": FlagField("flags", 2),
+	"followed_by": FlagField("flags", 3)
+})
+
+# Records that haven't been used in a while can have their bulky keys
+# (entities, cards) frozen: pickled and compressed into record.cold, while the
+# slots the indices read stay as they are. Reading or writing a frozen key
+# thaws the record again. Records are compressed one at a time, so to get
+# anywhere with a few hundred bytes each the compressor is primed with a
+# dictionary made from the first records that are frozen. The freezer of a
+# record is kept in record.cold, tables that touch their records have it too.
+#
+# Search reads the text and media urls of every tweet, the text isn't frozen
+# and the media urls are kept as a summary next to the compressed values.
+
+def tweet_is_cold(key, value):
+	if key == "entities":
+		# the media tab index reads these, and empty ones are shared anyway
+		return type(value) is dict and any(value.values()) and "media" not in value
+	return key in ("extended_entities", "display_text_range", "card", "quoted_status_permalink")
+
+def tweet_cold_summary(values):
+	"media urls of the frozen extended_entities, for tweet_media_urls"
+	return tuple(media.get("media_url_https", "") for media in values.get("extended_entities", {}).get("media", []))
+
+def tweet_media_urls(tweet):
+	"media urls of a tweet, without thawing it"
+	if tweet.is_cold("extended_entities"):
+		return tweet.frozen_summary()
+	return [media.get("media_url_https", "") for media in tweet.get("extended_entities", {}).get("media", [])]
+
+class Freezer:
+	def __init__(self, is_cold, hot=100000, codec=None, summarize=None):
+		self.is_cold = is_cold # (key, value) -> bool
+		self.summarize = summarize # frozen values -> what to keep uncompressed
+		self.hot = hot # records kept thawed
+		self.codec = codec or ("zstd" if zstandard else "zlib")
+		self.recent = collections.OrderedDict() # id(record) -> record, least recently used first
+		self.zdict = None
+		self.frozen = 0
+		self.raw_bytes = 0 # of what's frozen now, before and after compression
+		self.compressed_bytes = 0
+		self.hits = 0 # table lookups of thawed records
+		self.misses = 0 # and of frozen ones
+		self.thaws = 0
+		self.thaw_seconds = 0.0
+		self.thaw_seconds_max = 0.0
+
+	def touch(self, record):
+		if record.cold is not None:
+			self.misses += 1
+			return # joins when it's thawed
+		key = id(record)
+		if key in self.recent:
+			self.hits += 1
+			self.recent.move_to_end(key)
+			return
+		self.recent[key] = record
+		if len(self.recent) > self.hot:
+			if self.zdict is None:
+				self.train()
+			while len(self.recent) > self.hot:
+				self.freeze(self.recent.popitem(last=False)[1])
+
+	def cold_values(self, record):
+		return {key: value for key, value in record.items() if self.is_cold(key, value)}
+
+	def train(self):
+		samples = []
+		for record in self.recent.values():
+			values = self.cold_values(record)
+			if values:
+				samples.append(pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+			if len(samples) == 2000:
+				break
+		if self.codec == "zstd":
+			try:
+				self.zdict = zstandard.train_dictionary(64 * 1024, samples)
+			except zstandard.ZstdError:
+				self.zdict = zstandard.ZstdCompressionDict(b"".join(samples)[-64 * 1024:])
+			self.compressor = zstandard.ZstdCompressor(dict_data=self.zdict)
+			self.decompressor = zstandard.ZstdDecompressor(dict_data=self.zdict)
+		else:
+			self.zdict = b"".join(samples)[-32 * 1024:] # zlib only looks back 32k
+
+	def compress(self, data):
+		if self.codec == "zstd":
+			return self.compressor.compress(data)
+		c = zlib.compressobj(zdict=self.zdict)
+		return c.compress(data) + c.flush()
+
+	def decompress(self, data):
+		if self.codec == "zstd":
+			return self.decompressor.decompress(data)
+		d = zlib.decompressobj(zdict=self.zdict)
+		return d.decompress(data) + d.flush()
+
+	def unpack(self, data):
+		return pickle.loads(self.decompress(data))
+
+	def freeze(self, record):
+		values = self.cold_values(record)
+		if not values:
+			return
+		for key in values:
+			del record[key]
+		raw = pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+		data = self.compress(raw)
+		summary = self.summarize(values) if self.summarize else None
+		record.cold = (tuple(values), data, summary, self)
+		self.frozen += 1
+		self.raw_bytes += len(raw)
+		self.compressed_bytes += len(data)
+
+	def thaw(self, record):
+		t0 = time.perf_counter()
+		keys, data, summary, freezer = record.cold
+		raw = self.decompress(data)
+		record.cold = None
+		record.update(pickle.loads(raw))
+		seconds = time.perf_counter() - t0
+		self.frozen -= 1
+		self.raw_bytes -= len(raw)
+		self.compressed_bytes -= len(data)
+		self.thaws += 1
+		self.thaw_seconds += seconds
+		self.thaw_seconds_max = max(self.thaw_seconds_max, seconds)
+		self.touch(record)
+
+	def stats(self):
+		return {
+			"codec": self.codec,
+			"hot": len(self.recent),
+			"frozen": self.frozen,
+			"raw_bytes": self.raw_bytes,
+			"compressed_bytes": self.compressed_bytes,
+			"ratio": self.raw_bytes / self.compressed_bytes if self.compressed_bytes else None,
+			"thaws": self.thaws,
+			"thaw_ms_avg": 1000 * self.thaw_seconds / self.thaws if self.thaws else None,
+			"thaw_ms_max": 1000 * self.thaw_seconds_max
+		}
+
+class RecordTable(dict):
+	"a dict that turns the dicts stored in it into records of one type"
+	def __init__(self, record_type, freezer=None):
+		dict.__init__(self)
+		self.record_type = record_type
+		self.freezer = freezer # told about every record that's used, if any
+
+	def __getitem__(self, key):
+		record = dict.__getitem__(self, key)
+		if self.freezer:
+			self.freezer.touch(record)
+		return record
+
+	def get(self, key, default=None):
+		record = dict.get(self, key, default)
+		if self.freezer and record is not default:
+			self.freezer.touch(record)
+		return record
+
+	def peek(self, key, default=None):
+		"like get, but without counting as a use, for passes over all records"
+		return dict.get(self, key, default)
+
+	def __setitem__(self, key, value):
+		if not isinstance(value, Record):
+			value = self.record_type(value)
+		dict.__setitem__(self, key, value)
+		if self.freezer:
+			self.freezer.touch(value)
+
+	def setdefault(self, key, default=None):
+		record = dict.get(self, key, None)
+		if record is None:
+			record = default if isinstance(default, Record) else self.record_type(default or ())
+			dict.__setitem__(self, key, record)
+		if self.freezer:
+			self.freezer.touch(record)
+		return record
+
+	def __reduce__(self):
+		return (type(self), (self.record_type,), None, None, iter(self.items()))
@@ -1,13 +1,16 @@
-from db import db, urlmap_entities, urlmap_card, urlmap_profile, OnDisk, InZip, InMemory, InWarc # db will process sys.argv
+from db import db, dicts, options, urlmap_entities, urlmap_card, urlmap_profile, OnDisk, InZip, InMemory, InWarc, InConcat # db will process sys.argv
 
-import os.path, time, datetime, sys, cProfile, pstats, io, math
+import os.path, time, datetime, sys, cProfile, pstats, io, math, mimetypes
 from urllib.parse import urlparse, urlunparse, quote as urlquote, unquote as urlunquote
 server_path = os.path.dirname(__file__)
 sys.path.append(server_path + "/vendor") # use bundled copy of bottle, if system has none
-from bottle import parse_date, request, route, run, static_file, HTTPError, HTTPResponse
+from bottle import default_app, parse_date, parse_range_header, request, route, run, static_file, HTTPError, HTTPResponse
 from pprint import pprint
+import prefork, memstats
+from metrics import Metrics
 
 use_twitter_cdn_for_images = False
+workers = int(options.get("workers", 1)) # >1 forks worker processes sharing the loaded db
 
 class ClientAPI:
 	def __init__(self, db):
@@ -127,25 +130,19 @@ class ClientAPI:
 	def interactions_view(self, uid):
 		return [self.get_tweet(twid) for twid in self.db.get_user_interactions(uid)]
 
-	def thread_view(self, twid):
+	def thread_view(self, twid, **kwargs):
+		ancestors, replies, cursor = self.db.new_thread_view(twid, **kwargs)
+		layout = ancestors + [twid] if "cursor" not in kwargs else []
+		layout += [reply for level, reply in replies]
 		seq = []
-
-		layout = self.db.new_thread_view(twid)
-		def flatten(l):
-			if isinstance(l, int):
-				_, t = self.get_tweet(l)
-				if t:
-					seq.append(t)
-			elif isinstance(l, list):
-				for sort_index, name, mod in l:
-					flatten(mod)
-			else:
-				assert False
-		flatten(layout)
+		for twid in layout:
+			_, t = self.get_tweet(twid)
+			if t:
+				seq.append(t)
 		for i in range(0, len(seq)-1):
 			if seq[i].get("id_str", -1) == seq[i+1].get("in_reply_to_status_id_str", -2):
 				seq[i]["line"] = True
-		return seq
+		return seq, cursor
 
 	def search(self, query):
 		return [self.get_tweet(twid) for twid in self.db.search(query)]
@@ -161,22 +158,25 @@ class ClientAPI:
 		p = urlmap_profile(self.urlmap, p)
 		return p
 
-	def followers(self, uid):
-		return [self.get_profile(uid) for uid in self.db.followers.get(uid, [])]
+	def followers(self, uid, cursor=None, limit=300):
+		uids, cursor = self.db.get_followers(uid, cursor, limit)
+		return [self.get_profile(uid) for uid in uids], cursor
 
-	def following(self, uid):
-		return [self.get_profile(uid) for uid in self.db.followings.get(uid, [])]
+	def following(self, uid, cursor=None, limit=300):
+		uids, cursor = self.db.get_followings(uid, cursor, limit)
+		return [self.get_profile(uid) for uid in uids], cursor
 
-	def everyone(self):
-		uids = [(-len(self.db.by_user.get(uid, [])), uid) for uid in self.db.profiles.keys()]
-		uids.sort()
-		return [self.get_profile(uid) for neg_num_tweets, uid in uids if -neg_num_tweets >= 2]
+	def everyone(self, prefix=None, cursor=0, limit=300):
+		uids, cursor = self.db.get_everyone(prefix, cursor, limit)
+		return [self.get_profile(uid) for uid in uids], cursor
 
 	# direct messages
 
-	def conversations(self):
+	def conversations(self, cursor=0, limit=300):
 		r = []
-		for cid, c in self.db.conversations.items():
+		cids, cursor = self.db.get_conversations(cursor, limit)
+		for cid in cids:
+			c = self.db.conversations[cid]
 			if "-" in cid:
 				a, b = cid.split("-")
 				if int(a) not in db.observers and int(b) in db.observers:
@@ -184,23 +184,23 @@ class ClientAPI:
 				r.append([cid, self.get_profile(int(a)), self.get_profile(int(b)), c["messages"][0]])
 			else:
 				r.append([cid, None, None, c["messages"][0]])
-		return r
+		return r, cursor
 
-	def conversation(self, cid):
+	def conversation(self, cid, cursor=None, limit=300):
 		if cid not in self.db.conversations:
-			return None
-		c = self.db.conversations[cid]
+			return None, None
+		messages, cursor = self.db.get_messages(cid, cursor, limit)
 		c = {
 			"conversationId": cid,
-			"messages": c["messages"]
+			"messages": messages
 		}
 		if "-" in cid:
 			a, b = cid.split("-")
 			if int(a) not in db.observers and int(b) in db.observers:
 				a, b = b, a
-			return [c, self.get_profile(int(a)), self.get_profile(int(b))]
+			return [c, self.get_profile(int(a)), self.get_profile(int(b))], cursor
 		else:
-			return [c, None, None]
+			return [c, None, None], cursor
 
 ca = ClientAPI(db)
 
@@ -237,6 +237,12 @@ def query_string_substitute(qs, rkey, rvalue, encoding="utf8"):
 		r.append(urlquote(rkey)+'='+urlquote(rvalue))
 	return '&'.join(r)
 
+def link_next_page(response, cursor):
+	if cursor:
+		response["cursor"] = str(cursor)
+		final_qs = query_string_substitute(request.query_string, "cursor", str(cursor))
+		response["final_link"] = {"href": "?"+final_qs, "content": "Load more"}
+
 def paginated_tweets(response):
 	def tweet_date(tweet):
 		if "created_at" in tweet:
@@ -345,7 +351,7 @@ def home(who):
 	try:
 		uid = int(who)
 	except:
-		uids = db.user_by_handle.get(who, set())
+		uids = db.find_users(who)
 		if len(uids) != 1:
 			return paginated_tweets({
 				"profiles": [ca.get_profile(uid) for uid in uids]
@@ -369,7 +375,7 @@ def profile2(who):
 	except: pass
 	else: return profile(uid)
 
-	uids = db.user_by_handle.get(who, set())
+	uids = db.find_users(who)
 	if len(uids) == 1:
 		uid, = uids
 		return profile(uid)
@@ -378,6 +384,16 @@ def profile2(who):
 			"profiles": [ca.get_profile(uid) for uid in uids]
 		})
 
+@route('/api/users/suggest')
+def suggest_users():
+	q = request.query
+	try:
+		limit = int(q.get("limit", 10))
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	uids = db.suggest_users(q.getunicode("q", ""), limit)
+	return {"profiles": [ca.get_profile(uid) for uid in uids]}
+
 @route('/api/replies/<uid:int>')
 def replies(uid):
 	return paginated_tweets({
@@ -421,51 +437,174 @@ def search():
 
 @route('/api/thread/<twid:int>')
 def thread(twid):
-	return {
-		"tweets": ca.thread_view(twid)
+	q = request.query
+	try:
+		kwargs = {
+			"depth": int(q.get("depth", 3)),
+			"breadth": int(q.get("breadth", 10)),
+			"limit": int(q.get("limit", 300))
+		}
+		if "cursor" in q:
+			kwargs["cursor"] = int(q.cursor)
+		tweets, cursor = ca.thread_view(twid, **kwargs)
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	response = {
+		"tweets": tweets
 	}
+	link_next_page(response, cursor)
+	return response
 
-@route('/api/followers/<uid:int>')
-def followers(uid):
-	return {
+def paginated_profiles(uid, view):
+	q = request.query
+	try:
+		cursor = int(q.cursor) if "cursor" in q else None
+		limit = int(q.get("limit", 300))
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	profiles, cursor = view(uid, cursor, limit)
+	response = {
 		"topProfile": ca.get_profile(uid),
-		"profiles": ca.followers(uid)[:300]
+		"profiles": profiles
 	}
+	link_next_page(response, cursor)
+	return response
+
+@route('/api/followers/<uid:int>')
+def followers(uid):
+	return paginated_profiles(uid, ca.followers)
 
 @route('/api/following/<uid:int>')
 def following(uid):
-	return {
-		"topProfile": ca.get_profile(uid),
-		"profiles": ca.following(uid)[:300]
-	}
+	return paginated_profiles(uid, ca.following)
 
 @route('/api/everyone')
 def everyone():
-	return {"profiles": ca.everyone()}
+	q = request.query
+	try:
+		cursor = int(q.get("cursor", 0))
+		limit = int(q.get("limit", 300))
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	profiles, cursor = ca.everyone(q.getunicode("prefix", None), cursor, limit)
+	response = {"profiles": profiles}
+	link_next_page(response, cursor)
+	return response
+
+def conversation_list(response):
+	q = request.query
+	try:
+		cursor = int(q.get("conversations_cursor", 0))
+		limit = int(q.get("conversations_limit", 300))
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	conversations, cursor = ca.conversations(cursor, limit)
+	response["conversations"] = conversations
+	if cursor:
+		response["conversations_cursor"] = str(cursor)
+	return response
 
 @route('/api/dm')
 def conversations():
-	return {"conversations": ca.conversations()}
+	return conversation_list({})
 
-@route('/api/dm/<cid>')
-def conversation(cid):
-	return {
-		"conversations": ca.conversations(),
-		"conversation": ca.conversation(cid)
+@route('/api/dm/search')
+def search_messages():
+	q = request.query
+	try:
+		cursor = int(q.cursor) if "cursor" in q else None
+		limit = int(q.get("limit", 100))
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	results, cursor = db.search_messages(q.getunicode("q", ""),
+		cid=q.getunicode("conversation", None), sender=q.getunicode("sender", None),
+		cursor=cursor, limit=limit)
+	response = {
+		"results": [{"conversationId": cid, "message": message} for cid, message in results]
 	}
+	link_next_page(response, cursor)
+	return response
 
-@route('/api/reload')
-def reload():
-	if False:
-		db.reload()
-		return
+@route('/api/dm/<cid>')
+def conversation(cid):
+	q = request.query
+	try:
+		cursor = int(q.cursor) if "cursor" in q else None
+		limit = int(q.get("limit", 300))
+	except ValueError as e:
+		raise HTTPError(400, str(e))
+	conversation, cursor = ca.conversation(cid, cursor, limit)
+	response = conversation_list({"conversation": conversation})
+	link_next_page(response, cursor)
+	if "final_link" in response:
+		response["final_link"]["content"] = "Load older messages"
+	return response
 
+def profiled_reload():
 	p = cProfile.Profile()
 	p.runcall(db.reload)
 	s = pstats.Stats(p)
 	s.stream = io.StringIO()
 	s.strip_dirs().sort_stats("cumulative").print_stats()
-	return HTTPResponse(s.stream.getvalue(), status=200, **{"Content-Type": "text/plain"})
+	return s.stream.getvalue()
+
+@route('/api/reload')
+def reload():
+	if workers > 1:
+		# the parent reloads and replaces all workers, including this one
+		prefork.request_reload()
+		return HTTPResponse("reload requested\n", status=202, **{"Content-Type": "text/plain"})
+
+	return HTTPResponse(profiled_reload(), status=200, **{"Content-Type": "text/plain"})
+
+@route('/api/debug/workers')
+def debug_workers():
+	if workers <= 1:
+		return {"parent": None, "workers": [{"pid": os.getpid(), "current": True, "memory": prefork.memory_usage(os.getpid())}]}
+	return prefork.worker_report()
+
+@route('/api/debug/memory')
+def debug_memory():
+	try:
+		n = max(1, int(request.query.sample or 100))
+	except ValueError:
+		raise HTTPError(400, "sample must be a number")
+	tables = memstats.report(db, [("intern_dict", dicts)], n)
+	sources = {}
+	for path, added in db.added_by_source.items():
+		source = sources[path] = dict(added)
+		# a source's share of a table, sqlite tables only have some of their rows in memory
+		source["bytes"] = sum(
+			count * tables[name]["bytes"] // tables[name].get("rows", tables[name]["count"])
+			for name, count in added.items() if tables.get(name, {}).get("rows", tables.get(name, {}).get("count")))
+	usage = prefork.memory_usage(os.getpid()) or {}
+	return {"rss_kb": usage.get("Rss", None), "sample": n, "attributes": tables, "sources": sources}
+
+@route('/api/debug/ingest')
+def debug_ingest():
+	stats = db.ingest
+	return {
+		"reloads": list(stats.reloads),
+		"sources": stats.sources,
+		"operations": dict(sorted(stats.operations.items(), key=lambda item: -item[1].get("seconds", 0))),
+		"gql_unknown": dict(db.gql_unknown.most_common())
+	}
+
+@route('/api/debug/metrics')
+def debug_metrics():
+	caches = {"remux": db.media.remux_cache}
+	freezer = getattr(db.tweets, "freezer", None) # no freezer for sqlite tables
+	if freezer:
+		caches["cold tweets"] = freezer
+	if db.storage:
+		for name, table in db.storage.tables.items():
+			caches["sqlite " + name] = table
+	return metrics.report(caches)
+
+@route('/api/debug/cold')
+def debug_cold():
+	freezer = getattr(db.tweets, "freezer", None)
+	return freezer.stats() if freezer else {"codec": None}
 
 
 @route('/fonts/<path:path>')
@@ -486,11 +625,21 @@ def preact_js(path):
 
 startup_time = time.time()
 
-def static_blob(data, mime, mtime = None):
+def iter_range(f, offset, length, chunk_size=64*1024):
+	with f:
+		f.seek(offset)
+		while length > 0:
+			part = f.read(min(length, chunk_size))
+			if not part:
+				break
+			length -= len(part)
+			yield part
+
+def static_item(item, mime, mtime = None):
 	mtime = mtime or startup_time
 
 	headers = {}
-	headers['Content-Type'] = mime
+	headers['Content-Type'] = mime or "application/octet-stream"
 	lm = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(mtime))
 	headers['Last-Modified'] = lm
 
@@ -501,8 +650,31 @@ def static_blob(data, mime, mtime = None):
 		headers['Date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
 		return HTTPResponse(status=304, **headers)
 
-	body = '' if request.method == 'HEAD' else data
-	return HTTPResponse(body, status=200, **headers)
+	clen = item.content_length()
+	if clen is None:
+		# compressed warc payloads have to be decoded to learn their size
+		item = InMemory(item.open_bytes().read())
+		clen = item.content_length()
+	headers['Content-Length'] = clen
+	headers['Accept-Ranges'] = 'bytes'
+
+	ranges = request.environ.get('HTTP_RANGE')
+	if_range = request.environ.get('HTTP_IF_RANGE')
+	if ranges and if_range and parse_date(if_range) != int(mtime):
+		ranges = None # client has an outdated copy, send everything
+
+	offset, end, status = 0, clen, 200
+	if ranges:
+		ranges = list(parse_range_header(ranges, clen))
+		if not ranges:
+			return HTTPError(416, "Requested Range Not Satisfiable", **{"Content-Range": "bytes */%d" % clen})
+		offset, end = ranges[0]
+		headers['Content-Range'] = "bytes %d-%d/%d" % (offset, end-1, clen)
+		headers['Content-Length'] = str(end-offset)
+		status = 206
+
+	body = '' if request.method == 'HEAD' else iter_range(item.open_bytes(), offset, end-offset)
+	return HTTPResponse(body, status=status, **headers)
 
 @route('/media/<path:path>')
 def media(path):
@@ -513,13 +685,10 @@ def media(path):
 	if not cacheable and "HTTP_IF_MODIFIED_SINCE" in request.environ:
 		del request.environ["HTTP_IF_MODIFIED_SINCE"]
 	if isinstance(item, OnDisk):
-		response = static_file(os.path.basename(item.path), root=os.path.dirname(item.path), mimetype=getattr(item, "mime", "auto"))
-	elif isinstance(item, (InZip, InWarc)):
-		with item.open() as f:
-			response = static_blob(f.read(), item.mime)
-	elif isinstance(item, InMemory):
-		# todo: caching headers, range queries?
-		response = static_blob(item.data, item.mime)
+		mime = getattr(item, "mime", None) or mimetypes.guess_type(item.path)[0]
+		response = static_item(item, mime, os.path.getmtime(item.path))
+	elif isinstance(item, (InZip, InWarc, InMemory, InConcat)):
+		response = static_item(item, getattr(item, "mime", None))
 	else:
 		return HTTPError(404)
 
@@ -554,4 +723,10 @@ def favicon():
 def index(**args):
 	return static_file('index.html', root=server_path+'/static')
 
-run()
+# requests slower than this are profiled, see metrics.py
+metrics = Metrics(default_app(), slow_ms=int(options.get("slow-ms", 500)))
+
+if workers > 1:
+	run(metrics, server=prefork.PreforkServer(workers=workers, reload=lambda: print(profiled_reload())))
+else:
+	run(metrics)
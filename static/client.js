@@ -865,9 +865,14 @@ class App extends Component {
                         h("span", null, this.props.conversation
                             ? this.props.conversation[2].name
                             : "")),
-                    h("div", { class: "t20230912-dm-conversation" }, this.props.conversation
-                        ? this.props.conversation[0].messages.map((x, i) => h(DMMessage, { conv: this.props.conversation, msg: x, index: i }))
-                        : "Select a message"),
+                    h("div", { class: "t20230912-dm-conversation" },
+                        this.props.conversation && this.props.final_link
+                            ? h("div", { class: "timeline-system-message" },
+                                h("a", { class: "deemphasized-link", href: this.props.final_link.href }, this.props.final_link.content))
+                            : [],
+                        this.props.conversation
+                            ? this.props.conversation[0].messages.map((x, i) => h(DMMessage, { conv: this.props.conversation, msg: x, index: i }))
+                            : "Select a message"),
                     h("div", { class: "t20230912-dm-editor" },
                         h("div", null),
                         h("div", null, "What would you have said?"))));
@@ -1162,6 +1162,11 @@ class App extends Component<AppProps, AppState> {
 						</span>
 					</div>
 					<div class="t20230912-dm-conversation">
+						{this.props.conversation && this.props.final_link
+						 ? <div class="timeline-system-message">
+							<a class="deemphasized-link" href={this.props.final_link.href}>{this.props.final_link.content}</a>
+						 </div>
+						 : []}
 						{this.props.conversation
 						 ? this.props.conversation[0].messages.map((x, i)=> <DMMessage conv={this.props.conversation} msg={x} index={i}/>)
 						 : "Select a message"}
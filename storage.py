@@ -0,0 +1,240 @@
+# Out-of-core storage for the big DB tables (tweets, profiles, replies,
+# by_user, conversations), for corpora that don't fit in memory.
+#
+#   python db.py --sqlite=corpus.sqlite3 [--sqlite-cache=100000] ...
+#
+# Each table is a key/value table in one sqlite database, values are pickled.
+# A SqliteTable keeps the most recently used rows as live objects, so the
+# loaders can keep mutating what they got from it like they do with dicts
+# (tweet["favoriters"].append(...), replies.setdefault(...).insert(...)). When
+# a row drops out of that cache it's pickled again and only written if it
+# changed, and writes are collected into batches for executemany. A value
+# fetched from a table stays the live copy for as long as it is among the
+# `cache` most recently used rows of its table, so don't hold on to rows across
+# a whole pass over another part of the same table.
+#
+# The file is a cache of the inputs, not a database of its own: it's cleared
+# when opened, and the inputs are read again.
+#
+# Only SqliteStore.flush() commits, once at the end of every reload, so forked
+# workers keep reading the previous state of the tables (by_user is rebuilt
+# from scratch) until the reload is complete.
+#
+# DMs and their search index, followers, likes, bookmarks and the user
+# indices stay in memory.
+
+import collections, collections.abc, os, pickle, sqlite3
+from records import Record
+
+class SqliteStore:
+	def __init__(self, path, cache=100000, batch=1000):
+		self.path = path
+		self.cache = cache # rows per table
+		self.batch = batch # rows per executemany
+		self.tables = {}
+		self.readonly = False
+		self.connect()
+		if hasattr(os, "register_at_fork"):
+			# sqlite connections can't be shared with forked server workers
+			os.register_at_fork(after_in_child=self.reopen)
+
+	def connect(self):
+		self.conn = sqlite3.connect(self.path)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+
+	def reopen(self):
+		# workers only read, what they change is for the request at hand
+		self.readonly = True
+		self.connect()
+		for table in self.tables.values():
+			table.pending.clear()
+
+	def table(self, name, record_type=None):
+		table = SqliteTable(self, name, record_type)
+		self.tables[name] = table
+		return table
+
+	def replace(self, name, items):
+		"a table with just these items, for indices that are rebuilt as a whole"
+		table = self.tables.get(name, None) or self.table(name)
+		table.clear()
+		for key, value in items:
+			table[key] = value
+		return table
+
+	def flush(self):
+		for table in self.tables.values():
+			table.flush(commit=False)
+		self.conn.commit()
+
+class SqliteTable(collections.abc.MutableMapping):
+	def __init__(self, store, name, record_type=None):
+		self.store = store
+		self.name = name
+		self.record_type = record_type
+		self.cache = collections.OrderedDict() # key -> [value, pickle as loaded, or None if new]
+		self.pending = {} # key -> pickle, written on the next flush
+		self.writes = 0 # batches written, so items() knows when its page got stale
+		self.hits = self.misses = 0
+		store.conn.execute("DROP TABLE IF EXISTS {}".format(name))
+		store.conn.execute("CREATE TABLE {} (k PRIMARY KEY, v BLOB) WITHOUT ROWID".format(name))
+		self.sql_get = "SELECT v FROM {} WHERE k = ?".format(name)
+		self.sql_put = "INSERT OR REPLACE INTO {} (k, v) VALUES (?, ?)".format(name)
+		self.sql_delete = "DELETE FROM {} WHERE k = ?".format(name)
+		self.sql_first = "SELECT k, v FROM {} ORDER BY k LIMIT ?".format(name)
+		self.sql_after = "SELECT k, v FROM {} WHERE k > ? ORDER BY k LIMIT ?".format(name)
+		self.sql_count = "SELECT COUNT(*) FROM {}".format(name)
+		self.sql_keys_first = "SELECT k FROM {} ORDER BY k LIMIT ?".format(name)
+		self.sql_keys_after = "SELECT k FROM {} WHERE k > ? ORDER BY k LIMIT ?".format(name)
+		self.sql_exists = "SELECT k FROM {} WHERE k IN ({{}})".format(name)
+
+	def load(self, key, data):
+		entry = self.cache.get(key, None)
+		if entry is not None: # newer than what's in the table
+			self.cache.move_to_end(key)
+			return entry[0]
+		value = pickle.loads(data)
+		self.cache[key] = [value, data]
+		self.evict()
+		return value
+
+	def evict(self):
+		while len(self.cache) > self.store.cache:
+			key, (value, data) = self.cache.popitem(last=False)
+			if self.store.readonly:
+				continue
+			new_data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+			if new_data != data:
+				self.pending[key] = new_data
+		if len(self.pending) >= self.store.batch:
+			self.write_pending()
+
+	def write_pending(self):
+		if not self.pending:
+			return
+		self.store.conn.executemany(self.sql_put, self.pending.items())
+		self.pending.clear()
+		self.writes += 1
+
+	def flush(self, commit=True):
+		if not self.store.readonly:
+			for key, entry in self.cache.items():
+				value, data = entry
+				new_data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+				if new_data != data:
+					self.pending[key] = entry[1] = new_data
+			self.write_pending()
+		if commit:
+			self.store.conn.commit()
+
+	def __getitem__(self, key):
+		entry = self.cache.get(key, None)
+		if entry is not None:
+			self.hits += 1
+			self.cache.move_to_end(key)
+			return entry[0]
+		self.misses += 1
+		data = self.pending.pop(key, None)
+		if data is not None:
+			value = pickle.loads(data)
+			self.cache[key] = [value, None] # not in the table yet
+			self.evict()
+			return value
+		row = self.store.conn.execute(self.sql_get, (key,)).fetchone()
+		if row is None:
+			raise KeyError(key)
+		return self.load(key, row[0])
+
+	def __contains__(self, key):
+		if key in self.cache or key in self.pending:
+			return True
+		return self.store.conn.execute(self.sql_get, (key,)).fetchone() is not None
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def peek(self, key, default=None):
+		# rows have to be loaded to be read, that makes them recently used here
+		return self.get(key, default)
+
+	def __setitem__(self, key, value):
+		if self.record_type and not isinstance(value, Record):
+			value = self.record_type(value)
+		self.pending.pop(key, None)
+		self.cache[key] = [value, None]
+		self.cache.move_to_end(key)
+		self.evict()
+
+	def setdefault(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			if self.record_type and not isinstance(default, Record):
+				default = self.record_type(default or ())
+			self[key] = default
+			return default
+
+	def __delitem__(self, key):
+		in_memory = self.cache.pop(key, None) is not None
+		in_memory = self.pending.pop(key, None) is not None or in_memory
+		cursor = self.store.conn.execute(self.sql_delete, (key,))
+		if not in_memory and cursor.rowcount == 0:
+			raise KeyError(key)
+
+	def clear(self):
+		self.cache.clear()
+		self.pending.clear()
+		self.store.conn.execute("DELETE FROM {}".format(self.name))
+
+	def items(self):
+		# in key order, a page at a time, so that no statement is left open
+		# while rows that drop out of the cache are written back
+		self.flush(commit=False)
+		rows = self.store.conn.execute(self.sql_first, (self.store.batch,)).fetchall()
+		while rows:
+			writes = self.writes
+			for key, data in rows:
+				if self.writes == writes and key not in self.pending:
+					yield key, self.load(key, data)
+					continue
+				# changed since the page was read, the cache, pending or the
+				# table have a newer version
+				try:
+					value = self[key]
+				except KeyError:
+					continue # deleted meanwhile
+				yield key, value
+			rows = self.store.conn.execute(self.sql_after, (rows[-1][0], self.store.batch)).fetchall()
+
+	def keys(self):
+		self.flush(commit=False)
+		rows = self.store.conn.execute(self.sql_keys_first, (self.store.batch,)).fetchall()
+		while rows:
+			for row in rows:
+				yield row[0]
+			rows = self.store.conn.execute(self.sql_keys_after, (rows[-1][0], self.store.batch)).fetchall()
+
+	def values(self):
+		for key, value in self.items():
+			yield value
+
+	def __iter__(self):
+		return self.keys()
+
+	def __len__(self):
+		# rows in the table, plus those only in memory so far. without writing
+		# them, so it's fine to ask from request handlers
+		count = self.store.conn.execute(self.sql_count).fetchone()[0]
+		unsaved = {key for key, entry in self.cache.items() if entry[1] is None}
+		unsaved.update(self.pending)
+		unsaved = list(unsaved)
+		for i in range(0, len(unsaved), 500):
+			chunk = unsaved[i:i+500]
+			sql = self.sql_exists.format(",".join("?" * len(chunk)))
+			saved = len(self.store.conn.execute(sql, chunk).fetchall())
+			count += len(chunk) - saved
+		return count
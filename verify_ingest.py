@@ -0,0 +1,62 @@
+# Check data sources against everything the loaders assume about the format
+# of the responses. Instead of stopping at the first response that doesn't
+# fit, like loading them in the server does, all of them are loaded and the
+# failures are listed, grouped by where they happened. Nothing is written to
+# harstore/, HARs that aren't in it yet are read where they are.
+#
+#   python verify_ingest.py <datasources>
+#
+# Exits with 1 if any response failed a check.
+
+import collections, sys, traceback
+
+sources = sys.argv[1:]
+sys.argv[1:] = ["--no-load"]
+import db as dbmodule
+from db import db
+
+db.har.readonly = True
+failures = collections.defaultdict(list) # (where, message) -> [(source, url)]
+current_source = [None]
+
+def record(e, url):
+	frame = traceback.extract_tb(e.__traceback__)[-1]
+	where = "{}:{} {}".format(frame.filename.rsplit("/", 1)[-1], frame.lineno, frame.name)
+	message = "{}: {}".format(type(e).__name__, str(e).split("\n", 1)[0][:200])
+	failures[(where, message)].append((current_source[0], url))
+
+load_api = db.load_api
+def checked_load_api(fname, item, context):
+	try:
+		load_api(fname, item, context)
+	except (AssertionError, KeyError, TypeError, ValueError) as e:
+		record(e, context.get("url", None))
+db.load_api = checked_load_api
+
+paths = dbmodule.gather_paths(sources)
+for path in paths:
+	current_source[0] = path
+	try:
+		dbmodule.load_single(path) # archives fail as a whole
+	except (AssertionError, KeyError, TypeError, ValueError) as e:
+		record(e, None)
+
+current_source[0] = "sort_profiles"
+try:
+	db.sort_profiles()
+except (AssertionError, KeyError, TypeError, ValueError) as e:
+	record(e, None)
+
+print()
+print("{} sources, {} tweets, {} profiles".format(len(paths), len(db.tweets), len(db.profiles)))
+for (where, message), examples in sorted(failures.items(), key=lambda item: -len(item[1])):
+	print()
+	print("{:5d}x {}".format(len(examples), message))
+	print("       at", where)
+	for source, url in examples[:3]:
+		print("       in", source, url or "")
+if failures:
+	print()
+	print("{} responses failed the checks".format(sum(len(examples) for examples in failures.values())))
+	sys.exit(1)
+print("all checks passed")